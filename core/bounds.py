@@ -2,6 +2,7 @@ import numpy as np
 from scipy.stats import binom
 from scipy.optimize import brentq
 import pdb
+from core.utils import cacheable
 
 def h1(y, mu):
     return y*np.log(y/mu) + (1-y)*np.log((1-y)/(1-mu))
@@ -17,18 +18,48 @@ def hoeffding_minus(mu, x, n):
     return -n * h1(np.minimum(mu,x),mu)
 
 def bentkus_plus(mu, x, n):
-    return np.log(max(binom.cdf(np.floor(n*x),n,mu),1e-10))+1
+    return np.log(np.maximum(binom.cdf(np.floor(n*x),n,mu),1e-10))+1
 
 def bentkus_minus(mu, x, n):
-    return np.log(max(binom.cdf(np.ceil(n*x),n,mu),1e-10))+1
+    return np.log(np.maximum(binom.cdf(np.ceil(n*x),n,mu),1e-10))+1
 
-def hb_p_value(r_hat,n,alpha):
-    bentkus_p_value = np.e * binom.cdf(np.ceil(n*r_hat),n,alpha)
+def _hoeffding_p_value(r_hat,n,alpha):
     def h1(y,mu):
-        with np.errstate(divide='ignore'):
+        with np.errstate(divide='ignore', invalid='ignore'):
             return y * np.log(y/mu) + (1-y) * np.log((1-y)/(1-mu))
-    hoeffding_p_value = np.exp(-n*h1(min(r_hat,alpha),alpha))
-    return min(bentkus_p_value,hoeffding_p_value)
+    return np.exp(-n*h1(np.minimum(r_hat,alpha),alpha))
+
+# Vectorized over r_hat, n and alpha, which broadcast against each other.
+def hb_p_value(r_hat,n,alpha):
+    r_hat = np.asarray(r_hat, dtype=float)
+    bentkus_p_value = np.e * binom.cdf(np.ceil(n*r_hat),n,alpha)
+    hoeffding_p_value = _hoeffding_p_value(r_hat,n,alpha)
+    # fmin ignores the NaN Hoeffding bound at r_hat in {0,1}, like the scalar min did
+    return np.fmin(bentkus_p_value,hoeffding_p_value)
+
+"""
+    LOOKUP TABLES FOR BINARY LOSSES
+"""
+# With {0,1} losses n*r_hat is an integer, so the p-value takes only n+1 values per (n, alpha).
+_hb_p_value_tables = {}
+
+# Entry k is hb_p_value at the float r_hat = k/n, which is what the mean of k ones out of n gives, so the table
+# agrees with hb_p_value exactly (including where n*(k/n) rounds above k and the ceil picks k+1).
+@cacheable
+def _hb_p_value_table(n, alpha):
+    return hb_p_value(np.arange(n+1)/n, n, alpha)
+
+def hb_p_value_table(n, alpha):
+    key = (int(n), float(alpha))
+    if key not in _hb_p_value_tables:
+        _hb_p_value_tables[key] = _hb_p_value_table(*key)
+    return _hb_p_value_tables[key]
+
+# Same as hb_p_value, but only valid when the losses are {0,1}.
+def hb_p_value_binary(r_hat, n, alpha):
+    table = hb_p_value_table(n, alpha)
+    ks = np.rint(n*np.asarray(r_hat, dtype=float)).astype(int)
+    return table[np.clip(ks, 0, int(n))]
 
 def HB_mu_plus(muhat, n, delta, maxiters):
     def _tailprob(mu):
@@ -45,11 +76,50 @@ def HB_mu_minus(muhat, n, delta, maxiters):
         hoeffding_mu = hoeffding_minus(mu, muhat, n) 
         bentkus_mu = bentkus_minus(mu, muhat, n)
         return min(hoeffding_mu, bentkus_mu) - np.log(delta)
-    pdb.set_trace()
     if _tailprob(1e-10) > 0:
         return 0
     else:
         return brentq(_tailprob, 1e-10, muhat, maxiter=maxiters)
 
+"""
+    BATCHED HB CONFIDENCE BOUNDS
+"""
+# Bisection on whole arrays in lockstep; f(lo) and f(hi) must have opposite signs elementwise.
+def _batched_bisection(f, lo, hi, maxiters, xtol=1e-12):
+    f_lo = f(lo)
+    num_iters = min(maxiters, int(np.ceil(np.log2(max((hi-lo).max(),xtol)/xtol))))
+    for _ in range(num_iters):
+        mid = (lo+hi)/2
+        f_mid = f(mid)
+        same_sign = np.sign(f_mid) == np.sign(f_lo)
+        lo, f_lo = np.where(same_sign, mid, lo), np.where(same_sign, f_mid, f_lo)
+        hi = np.where(same_sign, hi, mid)
+    return (lo+hi)/2
+
+def _hb_tailprob_batched(hoeffding_fn, bentkus_fn, muhats, n, delta):
+    def _tailprob(mu):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hoeffding_mu = hoeffding_fn(mu, muhats, n)
+        bentkus_mu = bentkus_fn(mu, muhats, n)
+        return np.fmin(hoeffding_mu, bentkus_mu) - np.log(delta)
+    return _tailprob
+
+# Array versions of HB_mu_plus and HB_mu_minus.
+def HB_mu_plus_batched(muhats, n, delta, maxiters=1000):
+    muhats = np.asarray(muhats, dtype=float)
+    _tailprob = _hb_tailprob_batched(hoeffding_plus, bentkus_plus, muhats, n, delta)
+    hi = np.full_like(muhats, 1-1e-10)
+    lo = np.minimum(muhats, hi)
+    mu_plus = _batched_bisection(_tailprob, lo, hi, maxiters)
+    return np.where(_tailprob(hi) > 0, 1.0, mu_plus)
+
+def HB_mu_minus_batched(muhats, n, delta, maxiters=1000):
+    muhats = np.asarray(muhats, dtype=float)
+    _tailprob = _hb_tailprob_batched(hoeffding_minus, bentkus_minus, muhats, n, delta)
+    lo = np.full_like(muhats, 1e-10)
+    hi = np.maximum(muhats, lo)
+    mu_minus = _batched_bisection(_tailprob, lo, hi, maxiters)
+    return np.where(_tailprob(lo) > 0, 0.0, mu_minus)
+
 if __name__ == "__main__":
     print(HB_mu_minus(0.5, 100, 0.1, 1000))
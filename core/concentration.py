@@ -6,13 +6,12 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy.stats as stats
 from scipy.optimize import brentq
-from statsmodels.stats.multitest import multipletests
 import pdb
 from pathlib import Path
 import pickle as pkl
 from core.utils import *
 from core.bounds import hb_p_value, HB_mu_plus, HB_mu_minus
-from core.uniform_concentration import nu_plus
+from core.uniform_concentration import nu_plus, nu_plus_batched
 CACHE = str(Path(__file__).parent.absolute()) + '/.cache/'
 
 """
@@ -20,18 +19,31 @@ CACHE = str(Path(__file__).parent.absolute()) + '/.cache/'
 """
 # there should be N inputs (one for each possible choice in the grid of lambdas)
 # and the subset scoring function should output a real number for each subset of {1,...,N}
+# The remaining subset S is always the inputs above the last threshold, i.e. a suffix of the sorted
+# inputs, so S is passed to the scoring function as an array of indexes and each step is a searchsorted.
 def romano_wolf(inputs,subset_scoring_function):
     N = inputs.shape[0]
-    S = set(range(N))
-    R = set() 
-    while len(R) < N:
-        dR = S.intersection(set(np.nonzero(inputs <= subset_scoring_function(S))[0]))
-        if len(dR) == 0:
-            return np.array(list(R))
-        else:
-            S.difference_update(dR)
-            R.update(dR)
-    return np.array(list(R))
+    order = np.argsort(inputs, kind='stable')
+    sorted_inputs = inputs[order]
+    k = 0 # number of rejections so far
+    while k < N:
+        k_new = max(np.searchsorted(sorted_inputs, subset_scoring_function(order[k:]), side='right'), k)
+        if k_new == k:
+            break
+        k = k_new
+    return np.sort(order[:k])
+
+# Fast path when the score only depends on the subset size through a threshold that is nonincreasing in
+# the size, like the Bonferroni-style delta/len(S). The step-down then stops at the first sorted input
+# above its threshold, which is a single vectorized pass (a Holm step-down for delta/len(S)).
+# size_scoring_function must accept an array of subset sizes.
+def romano_wolf_monotone(inputs,size_scoring_function):
+    N = inputs.shape[0]
+    order = np.argsort(inputs, kind='stable')
+    sorted_inputs = inputs[order]
+    failures = ~(sorted_inputs <= size_scoring_function(N - np.arange(N)))
+    k = np.argmax(failures) if failures.any() else N
+    return np.sort(order[:k])
 
 """
     RW SPECIALIZATIONS
@@ -43,43 +55,85 @@ def romano_wolf(inputs,subset_scoring_function):
 def romano_wolf_HB(loss_table,lambdas,alpha,delta):
     n = loss_table.shape[0]
     r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
-    def subset_scoring_function(S):
-        return delta/len(S)
-    return romano_wolf(p_values,subset_scoring_function)
+    p_values = hb_p_value(r_hats,n,alpha)
+    def size_scoring_function(sizes):
+        return delta/sizes
+    return romano_wolf_monotone(p_values,size_scoring_function)
 
 def romano_wolf_CLT(loss_table,lambdas,alpha,delta):
     t_values = np.sqrt(loss_table.shape[0])*(alpha - loss_table.mean(axis=0))/loss_table.std(axis=0) 
     p_values = 1-stats.norm.cdf(t_values)
-    def subset_scoring_function(S):
-        return delta/len(S)
-    return romano_wolf(p_values,subset_scoring_function)
+    def size_scoring_function(sizes):
+        return delta/sizes
+    return romano_wolf_monotone(p_values,size_scoring_function)
 
 def romano_wolf_multiplier_bootstrap(loss_table,lambdas,alpha,delta,B=100):
+    N = loss_table.shape[1]
+    cs, r_hats = multiplier_bootstrap_means(loss_table,B)
+    inputs = -(alpha-r_hats) # Weird negative due to flipped sign in romano-wolf algorithm
+    thresholds = multiplier_bootstrap_thresholds(cs,np.argsort(inputs, kind='stable'),delta)
+    def size_scoring_function(sizes):
+        return thresholds[N-sizes]
+    return romano_wolf_monotone(inputs,size_scoring_function)
+
+"""
+    MULTIPLIER BOOTSTRAP ENGINE
+"""
+# Returns the B x N matrix of multiplier means cs[b] = mean_i((l_{i,:}-r_hat) * e_{i,b}) as one matrix
+# product accumulated over chunks of rows, so only chunk_size x B multipliers are held at a time.
+# The multipliers are drawn in the same order as np.random.random(size=(n,B)).
+# Tables with a weighted_row_sums method are never materialized.
+def multiplier_bootstrap_means(loss_table,B,chunk_size=1000):
     n = loss_table.shape[0]
     N = loss_table.shape[1]
     r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    z_table = loss_table - loss_table.mean(axis=0)[np.newaxis,:] # Broadcast so Z_{i,j}=l_{i,j}-mean_i(l_{i,j})
-    es = np.random.random(size=(n,B))
     cs = np.zeros((B,N))
-    # Bootstrapping
-    for b in range(B):
-        cs[b] = np.mean(z_table * es[:,b:b+1],axis=0)
-    def subset_scoring_function(S):
-        idx = np.array(list(S))
-        subset = cs[:,idx]
-        maxes = np.max(subset,axis=1)
-        return -np.quantile(maxes,1-delta,interpolation='higher') # Weird negative due to flipped sign in romano-wolf algorithm 
-    return romano_wolf(-(alpha-r_hats),subset_scoring_function)
+    for start in range(0,n,chunk_size):
+        es = np.random.random(size=(min(chunk_size,n-start),B))
+        if hasattr(loss_table,'weighted_row_sums'):
+            # implicit tables such as core.pfdr.PFDRLossTable
+            cs += loss_table.weighted_row_sums(es,start) - es.sum(axis=0)[:,np.newaxis]*r_hats[np.newaxis,:]
+        else:
+            z_chunk = loss_table[start:start+chunk_size] - r_hats[np.newaxis,:] # Z_{i,j}=l_{i,j}-mean_i(l_{i,j})
+            cs += es.T @ z_chunk
+    return cs/n, r_hats
+
+# The step-down removes hypotheses in the sorted order of its inputs, so the subset left after k
+# rejections is order[k:]. Sweeping from the end keeps a running per-draw maximum, which gives the
+# Romano-Wolf threshold for every k in one pass over column chunks.
+def multiplier_bootstrap_thresholds(cs,order,delta,chunk_size=1000):
+    B = cs.shape[0]
+    N = cs.shape[1]
+    thresholds = np.zeros((N,))
+    running_maxes = np.full((B,), -np.Inf)
+    for end in range(N,0,-chunk_size):
+        start = max(end-chunk_size,0)
+        block = cs[:,order[start:end]]
+        suffix_maxes = np.maximum(np.maximum.accumulate(block[:,::-1],axis=1)[:,::-1], running_maxes[:,np.newaxis])
+        thresholds[start:end] = -np.quantile(suffix_maxes,1-delta,axis=0,interpolation='higher')
+        running_maxes = suffix_maxes[:,0]
+    return thresholds
 
 """
     BONFERRONI MASTER ALGORITHM
 """
 def bonferroni(p_values,delta):
-    rejections, _, _, _ = multipletests(p_values,delta,method='holm',is_sorted=False,returnsorted=False)
+    rejections = holm(p_values,delta)
     R = np.nonzero(rejections)[0]
     return R 
 
+# Holm step-down along the last axis, so a (trials x N) matrix of p-values is corrected in one call.
+# Returns a boolean rejection array of the same shape. NaN p-values are never rejected.
+def holm(p_values,delta):
+    p_values = np.asarray(p_values)
+    N = p_values.shape[-1]
+    order = np.argsort(p_values, axis=-1, kind='stable')
+    sorted_p_values = np.take_along_axis(p_values, order, axis=-1)
+    sorted_rejections = np.logical_and.accumulate(sorted_p_values <= delta/np.arange(N,0,-1), axis=-1)
+    rejections = np.zeros(p_values.shape, dtype=bool)
+    np.put_along_axis(rejections, order, sorted_rejections, axis=-1)
+    return rejections
+
 """
     MULTISCALE MASTER ALGORITHM
 """
@@ -92,7 +146,7 @@ def multiscaleify(method, frac_data_coarse, loss_table, lambdas, alpha, delta, *
     small_table, big_table = (loss_table[:num_coarse,:], loss_table[num_coarse:,:])    
     
     r_hats_coarse = small_table.mean(axis=0) 
-    p_values_upper = np.array([hb_p_value(r_hat, num_coarse, alpha) for r_hat in r_hats_coarse])
+    p_values_upper = hb_p_value(r_hats_coarse,num_coarse,alpha)
     # TODO: Fix the second piece of the mask
     lambda_binary_mask = (r_hats_coarse <= alpha + 0.05).astype(float) * (r_hats_coarse > alpha - 0.05).astype(float)
     #lambda_binary_mask[-1] = 1.0 # Always include the last one.
@@ -116,7 +170,7 @@ def multiscaleify(method, frac_data_coarse, loss_table, lambdas, alpha, delta, *
 def oracle_HB(loss_table,lambdas,alpha,delta):
     n = loss_table.shape[0]
     r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
+    p_values = hb_p_value(r_hats,n,alpha)
     R = set(np.nonzero(p_values < delta)[0])
     return R
 
@@ -126,7 +180,7 @@ def oracle_HB(loss_table,lambdas,alpha,delta):
 def bonferroni_HB(loss_table,lambdas,alpha,delta):
     n = loss_table.shape[0]
     r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
+    p_values = hb_p_value(r_hats,n,alpha)
     return bonferroni(p_values,delta)
 
 def multiscale_bonferroni_HB(loss_table,lambdas,alpha,delta,frac_data_coarse=None):
@@ -141,26 +195,71 @@ def bonferroni_CLT(loss_table,lambdas,alpha,delta):
     BONFERRONI SEARCH MASTER ALGORITHM
 """
 def bonferroni_search(p_values,delta,downsample_factor):
-    N = p_values.shape[0]
-    N_coarse = max(int(p_values.shape[0]/downsample_factor),1)
+    R = np.nonzero(bonferroni_search_rejections(p_values,delta,downsample_factor))[0]
+    return R
+
+# Fixed sequence testing from every coarse start index, along the last axis of p_values so a batch of
+# p-value vectors can be searched at once. A start rejects everything up to the first failing index after
+# it, so an index is rejected iff it passes and the latest start at or before it comes after the latest failure.
+def bonferroni_search_rejections(p_values,delta,downsample_factor):
+    p_values = np.asarray(p_values)
+    N = p_values.shape[-1]
+    N_coarse = max(int(N/downsample_factor),1)
+    # Downsample, making sure to include the endpoints.
+    is_start = np.zeros((N,), dtype=bool)
+    is_start[0:N:downsample_factor] = True
+    is_start[[0,N-1]] = True
+    passes = p_values < delta/N_coarse
+    positions = np.arange(N)
+    last_start = np.maximum.accumulate(np.where(is_start, positions, -1))
+    last_failure = np.maximum.accumulate(np.where(passes, -1, positions), axis=-1)
+    return passes & (last_start > last_failure)
+
+# Same rejections as bonferroni_search, but p_value_function(indexes) is only called on the indexes the
+# search visits. All coarse starts are evaluated in one call first: a failing start rejects nothing, so only
+# the passing ones are walked. Each walk evaluates blocks that double in size, so it overshoots its failure
+# by at most 2x, and a start that was already visited by an earlier walk is skipped.
+def bonferroni_search_lazy(p_value_function,N,delta,downsample_factor,initial_block_size=16):
+    N_coarse = max(int(N/downsample_factor),1)
     # Downsample, making sure to include the endpoints.
-    coarse_indexes = set(range(0,N,downsample_factor))
-    coarse_indexes.update({0,N-1})
-    R = set() 
-    for idx in coarse_indexes:
-        _idx = idx
-        while _idx >= 0 and _idx < N and p_values[_idx] < delta/N_coarse:
-            R.update({_idx})
-            _idx = _idx + 1 
-    return np.array(list(R))
+    coarse_indexes = np.array(sorted(set(range(0,N,downsample_factor)).union({0,N-1})))
+    start_passes = np.asarray(p_value_function(coarse_indexes)) < delta/N_coarse
+    rejections = np.zeros((N,), dtype=bool)
+    frontier = 0 # every index below the frontier has been visited
+    for idx in coarse_indexes[start_passes]:
+        if idx < frontier:
+            continue
+        rejections[idx] = True
+        idx = idx + 1
+        block_size = initial_block_size
+        while idx < N:
+            idxs = np.arange(idx, min(idx+block_size,N))
+            passes = np.asarray(p_value_function(idxs)) < delta/N_coarse
+            if passes.all():
+                rejections[idxs] = True
+                idx = idx + idxs.shape[0]
+                block_size = 2*block_size
+                continue
+            first_failure = np.argmin(passes)
+            rejections[idxs[:first_failure]] = True
+            idx = idxs[first_failure] + 1
+            break
+        frontier = idx
+    return np.nonzero(rejections)[0]
 
 """
     BONFERRONI SEARCH SPECIALIZATIONS 
 """
-def bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor):
+# With lazy=True the empirical risks and p-values are only computed for the lambdas the search visits.
+# The eager path is faster unless the p-values are much more expensive than the risks, so it is the default.
+def bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor,lazy=False):
     n = loss_table.shape[0]
+    if lazy:
+        def p_value_function(idxs):
+            return hb_p_value(loss_table[:,idxs].mean(axis=0),n,alpha)
+        return bonferroni_search_lazy(p_value_function,loss_table.shape[1],delta,downsample_factor)
     r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
+    p_values = hb_p_value(r_hats,n,alpha)
     return bonferroni_search(p_values,delta,downsample_factor)
 
 def multiscale_bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor,frac_data_coarse=None):
@@ -205,20 +304,165 @@ def uniform_region(loss_table,lambdas,alpha,delta,m):
     ending_index = (r_hats < alpha).nonzero()[0][-1]
     R = np.array([])
     sig_figs = int(np.ceil(np.log10(lambdas.shape[0])))
-    for i in range(starting_index,ending_index):
-        rounded_empirical_risk = np.ceil(r_hats[i] * 10**sig_figs)/(10**sig_figs)#To make more efficient caching
-        if nu_plus(loss_table.shape[0], m, rounded_empirical_risk, alpha, delta, 20, lambdas.shape[0]) < alpha:
-            break
-    for j in reversed(range(i,ending_index)):
-        rounded_empirical_risk = np.ceil(r_hats[j] * 10**sig_figs)/(10**sig_figs)#To make more efficient caching
-        if nu_plus(loss_table.shape[0], m, np.round(r_hats[j],sig_figs), alpha, delta, 20, lambdas.shape[0]) < alpha:
-            break
+    # First index whose bound is below alpha, scanning up from the start (ending_index-1 if none)
+    rounded_empirical_risks = np.ceil(r_hats[starting_index:ending_index] * 10**sig_figs)/(10**sig_figs)
+    valid = nu_plus_batched(loss_table.shape[0], m, rounded_empirical_risks, alpha, delta, 20, lambdas.shape[0]) < alpha
+    i = starting_index + valid.argmax() if valid.any() else ending_index-1
+    # Last index whose bound is below alpha, scanning down to i (i if none)
+    rounded_empirical_risks = np.round(r_hats[i:ending_index],sig_figs)
+    valid = nu_plus_batched(loss_table.shape[0], m, rounded_empirical_risks, alpha, delta, 20, lambdas.shape[0]) < alpha
+    j = i + np.nonzero(valid)[0][-1] if valid.any() else i
     if i == j:
         R = np.array([])
     else:
         R = np.array([i,j]) 
     return R
 
+"""
+    BATCHED TRIAL ENGINE
+"""
+# num_trials random calibration/validation splits of n points, as a num_trials x n 0/1 matrix with num_calib
+# ones per row marking the calibration points. Each row is a uniform random permutation cut at num_calib.
+# With num_coarse, the calibration points are cut again and a (coarse, fine) pair of selections is returned,
+# the coarse one marking the first num_coarse calibration points of each permutation.
+# The splits are drawn from rng, e.g. np.random.default_rng(seed), or from the global np.random state without one.
+def split_selections(n, num_calib, num_trials, dtype=float, num_coarse=None, rng=None):
+    rng = np.random if rng is None else rng
+    calib_points = np.argsort(rng.random(size=(num_trials,n)), axis=1)[:,:num_calib]
+    cuts = (0, num_calib) if num_coarse is None else (0, num_coarse, num_calib)
+    selections = []
+    for start, stop in zip(cuts[:-1], cuts[1:]):
+        selection = np.zeros((num_trials,n), dtype=dtype)
+        np.put_along_axis(selection, calib_points[:,start:stop], 1, axis=1)
+        selections = selections + [selection,]
+    return selections[0] if num_coarse is None else tuple(selections)
+
+# Calibration and validation risks of every lambda in num_trials random splits of loss_table, without
+# shuffling or copying the table: the calibration sums of a chunk of trials are one matrix product with
+# its selection matrix and the validation sums are the column totals minus them. loss_table is n x ...,
+# and the risks come back as num_trials x ... arrays. Only chunk_size trials are drawn at a time.
+# With num_coarse the calibration risks are split into coarse and fine risks as in split_selections, and the
+# splits are drawn from rng as there.
+def batched_split_risks(loss_table, num_calib, num_trials, chunk_size=100, num_coarse=None, rng=None):
+    loss_table = np.asarray(loss_table)
+    n = loss_table.shape[0]
+    dtype = np.result_type(loss_table.dtype, np.float32)
+    flat_table = loss_table.reshape((n,-1)).astype(dtype, copy=False)
+    totals = flat_table.sum(axis=0, dtype=np.float64)
+    sizes = (num_calib,) if num_coarse is None else (num_coarse, num_calib-num_coarse)
+    cal_risks = [ np.zeros((num_trials,flat_table.shape[1])) for size in sizes ]
+    val_risks = np.zeros((num_trials,flat_table.shape[1]))
+    for start in range(0,num_trials,chunk_size):
+        selections = split_selections(n, num_calib, min(chunk_size,num_trials-start), dtype=dtype, num_coarse=num_coarse, rng=rng)
+        val_sums = totals[np.newaxis,:]
+        for risks, selection, size in zip(cal_risks, (selections,) if num_coarse is None else selections, sizes):
+            cal_sums = (selection @ flat_table).astype(np.float64)
+            risks[start:start+chunk_size] = cal_sums/size
+            val_sums = val_sums - cal_sums
+        val_risks[start:start+chunk_size] = val_sums/(n-num_calib)
+    trailing_shape = loss_table.shape[1:]
+    return tuple( risks.reshape((num_trials,)+trailing_shape) for risks in cal_risks + [val_risks,] )
+
+# Batched counterparts of bonferroni_HB and bonferroni_search_HB: cal_risks is num_trials x N and the
+# rejections come back as a num_trials x N boolean array, one row per trial.
+def bonferroni_HB_batched(cal_risks,n,alpha,delta):
+    p_values = hb_p_value(cal_risks,n,alpha)
+    return holm(p_values,delta)
+
+def bonferroni_search_HB_batched(cal_risks,n,alpha,delta,downsample_factor):
+    p_values = hb_p_value(cal_risks,n,alpha)
+    return bonferroni_search_rejections(p_values,delta,downsample_factor)
+
+"""
+    SPLIT FIXED SEQUENCE
+"""
+# Lambdas are flattened from a grid of any dimension to N points, and each carries p-values for L losses.
+# For every beta, the point whose L coarse p-values are all closest to beta, i.e. the argmin over points of
+# max_l |p_l - beta| = max(max_l p_l - beta, beta - min_l p_l). p_values_coarse is ... x L x N and the path
+# comes back as ... x len(betas); leading trial dimensions are searched chunk_size trials at a time.
+def split_fixed_sequence_path(p_values_coarse, betas, chunk_size=8):
+    p_values_coarse = np.asarray(p_values_coarse)
+    leading_shape = p_values_coarse.shape[:-2]
+    p_max = p_values_coarse.max(axis=-2).reshape((-1,1,p_values_coarse.shape[-1]))
+    p_min = p_values_coarse.min(axis=-2).reshape((-1,1,p_values_coarse.shape[-1]))
+    betas = np.asarray(betas)[np.newaxis,:,np.newaxis]
+    path = np.zeros((p_max.shape[0],betas.shape[1]), dtype=int)
+    for start in range(0,p_max.shape[0],chunk_size):
+        rows = slice(start,start+chunk_size)
+        path[rows] = np.maximum(p_max[rows] - betas, betas - p_min[rows]).argmin(axis=-1)
+    return path.reshape(leading_shape + (betas.shape[1],))
+
+# Split fixed sequence for a batch of trials. coarse_risks and fine_risks are trials x L x N risks of the
+# coarse and fine calibration splits, alphas has one entry per loss. The fine p-values are only computed
+# on each trial's path, and a point is rejected if the largest of its L fine p-values is below delta.
+# Returns a trials x N boolean array of rejections.
+def split_fixed_sequence_HB_batched(coarse_risks,fine_risks,n_coarse,n_fine,alphas,delta,betas=np.logspace(-9,0,200)):
+    alphas = np.asarray(alphas, dtype=float)[:,np.newaxis]
+    path = split_fixed_sequence_path(hb_p_value(coarse_risks,n_coarse,alphas), betas)
+    fine_path_risks = np.take_along_axis(fine_risks, path[:,np.newaxis,:], axis=2)
+    p_values_fine = hb_p_value(fine_path_risks,n_fine,alphas).max(axis=1)
+    rejections = np.zeros((coarse_risks.shape[0],coarse_risks.shape[2]), dtype=bool)
+    np.put_along_axis(rejections, path, p_values_fine < delta, axis=1)
+    return rejections
+
+"""
+    THRESHOLD RULES
+"""
+# `scores > lam` with a scalar lam compares in the scores' precision (e.g. float32), so the sorted
+# comparisons below must too, or scores equal to a lambda up to rounding would flip.
+def as_score_dtype(lambdas, score_vector):
+    lambdas = np.asarray(lambdas)
+    if np.issubdtype(score_vector.dtype, np.floating):
+        lambdas = lambdas.astype(score_vector.dtype)
+    return lambdas
+
+# Sorts the scores once and returns a function that gives, for any lambdas, how many scores are strictly above
+# each lambda and the sum of weight_vector over those scores, with one searchsorted in O(N log n).
+# weight_vector may also be n x k, in which case sums is N x k.
+def threshold_sums(score_vector, weight_vector):
+    order = np.argsort(score_vector, kind='stable')
+    sorted_scores = score_vector[order]
+    cumulative_weights = np.concatenate((np.zeros((1,)+weight_vector.shape[1:]), np.cumsum(weight_vector[order], axis=0)))
+    def sums_above(lambdas):
+        num_at_most = np.searchsorted(sorted_scores, as_score_dtype(lambdas, score_vector), side='right')
+        counts = score_vector.shape[0] - num_at_most
+        sums = cumulative_weights[-1] - cumulative_weights[num_at_most]
+        return counts, sums
+    return sums_above
+
+def sums_above_thresholds(score_vector, weight_vector, lambdas):
+    return threshold_sums(score_vector, weight_vector)(lambdas)
+
+# A rule that predicts when a score is above (or at most) lambda only changes when lambda crosses an observed
+# score, so every empirical risk is piecewise constant with breakpoints at the distinct scores. Testing at those
+# scores plus the lower end covers every prediction set in [lower, upper] exactly, with N the number of distinct
+# scores in that range instead of a grid size. Without a lower end, the first lambda sits just below every score.
+# The breakpoints must come from data the calibration never sees, or the grid (and N) would depend on it; with
+# max_points, they are thinned to that many evenly spaced quantiles so N is fixed before the data is seen.
+def threshold_breakpoints(scores, lower=None, upper=None, max_points=None):
+    scores = np.asarray(scores).flatten()
+    if lower is None:
+        lower = np.nextafter(scores.min(), -np.Inf)
+    if upper is None:
+        upper = np.Inf
+    in_range = scores[(scores > lower) & (scores <= upper)]
+    breakpoints = np.unique(np.concatenate(([lower], in_range)))
+    if max_points is not None and breakpoints.shape[0] > max_points:
+        breakpoints = breakpoints[np.unique(np.linspace(0, breakpoints.shape[0]-1, max_points).round().astype(int))]
+    return breakpoints
+
+# The coarse-grid cells where a risk curve (from held-out data) crosses alpha, widened by margin cells on each
+# side. Calibrated lambdas land near the crossing, so breakpoints are only needed there. Without a crossing,
+# the whole coarse range is returned.
+def crossing_region(coarse_lambdas, coarse_risks, alpha, margin=1):
+    below = np.asarray(coarse_risks) <= alpha
+    crossings = np.nonzero(below[1:] != below[:-1])[0]
+    if crossings.shape[0] == 0:
+        return coarse_lambdas[0], coarse_lambdas[-1]
+    lower = max(crossings[0]-margin, 0)
+    upper = min(crossings[-1]+1+margin, coarse_lambdas.shape[0]-1)
+    return coarse_lambdas[lower], coarse_lambdas[upper]
+
 """
     SIMULATION OF LOSSES
 """
@@ -352,3 +596,4 @@ if __name__ == "__main__":
         sns.despine(top=True,right=True)
         plt.tight_layout()
         plt.savefig(f"../outputs/concentration_results/{str(peak).replace('.','_')}_true_mean.pdf")
+
@@ -6,18 +6,18 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import scipy.stats as stats
 from scipy.optimize import brentq
-from statsmodels.stats.multitest import multipletests
 import pdb
 from pathlib import Path
 import pickle as pkl
 from utils import *
-from core.uniform_concentration import nu_plus, r_minus 
+from core.uniform_concentration import nu_plus, nu_plus_batched, r_minus 
 from core.concentration import * 
-from core.bounds import hb_p_value, HB_mu_plus, HB_mu_minus
+from core.bounds import hb_p_value, HB_mu_plus, HB_mu_minus, HB_mu_plus_batched, HB_mu_minus_batched
 from tqdm import tqdm
 CACHE = str(Path(__file__).parent.absolute()) + '/.cache/'
 
-def get_nus_rs_n(score_vector, correct_vector, lambdas):
+# Sorts the scores once and returns a function of the lambdas giving nus, rs and n like get_nus_rs_n.
+def get_nus_rs_n_function(score_vector, correct_vector):
     try:
         score_vector = score_vector.numpy()
         correct_vector = correct_vector.numpy()
@@ -25,55 +25,108 @@ def get_nus_rs_n(score_vector, correct_vector, lambdas):
         # already numpy
         pass
     n = score_vector.shape[0]
-    nus = np.array([(1-correct_vector)[score_vector > lam].astype(float).sum()/n for lam in lambdas])
-    nus = np.nan_to_num(nus)
-    rs = np.array([(score_vector > lam).astype(float).mean() for lam in lambdas])
-    rs = np.nan_to_num(rs)
-    return nus, rs, n
+    incorrect_sums = threshold_sums(score_vector, (1-correct_vector).astype(float))
+    def nus_rs_n(lambdas):
+        counts, num_incorrect = incorrect_sums(lambdas)
+        nus = np.nan_to_num(num_incorrect/n)
+        rs = np.nan_to_num(counts/n)
+        return nus, rs, n
+    return nus_rs_n
+
+def get_nus_rs_n(score_vector, correct_vector, lambdas):
+    return get_nus_rs_n_function(score_vector, correct_vector)(lambdas)
 
+# Score i is predicted at lambda j iff lambda j is strictly below it, so each row is a step function of the
+# number of lambdas below the score, which one searchsorted over the sorted lambdas gives for every row.
 def pfdr_loss_table(score_vector, correct_vector, lambdas, alpha):
-    n = score_vector.shape[0]
     N = lambdas.shape[0]
-    loss_table = np.zeros((n,N))
-    for j in range(N):
-        predict = score_vector > lambdas[j]
-        c = correct_vector
-        loss_table[:,j] = (1-c)*predict - alpha * predict + alpha 
+    lambdas = as_score_dtype(lambdas, score_vector)
+    lambda_order = np.argsort(lambdas, kind='stable')
+    num_below = np.searchsorted(lambdas[lambda_order], score_vector, side='left')
+    predict = np.zeros((score_vector.shape[0],N), dtype=bool)
+    predict[:,lambda_order] = np.arange(N)[np.newaxis,:] < num_below[:,np.newaxis]
+    c = np.asarray(correct_vector, dtype=float)[:,np.newaxis]
+    loss_table = (1-c)*predict - alpha * predict + alpha 
     return loss_table
 
+"""
+    IMPLICIT LOSS TABLES
+"""
+# Stands in for the dense pfdr_loss_table without holding n*N floats. Column means and stds come from
+# cumulative sums over the sorted scores, slicing gives another implicit table, and weighted_row_sums
+# gives es.T @ table[start:start+len(es)], which is all the multiplier bootstrap needs.
+class PFDRLossTable(object):
+    def __init__(self, score_vector, correct_vector, lambdas, alpha):
+        try:
+            score_vector = score_vector.numpy()
+            correct_vector = correct_vector.numpy()
+        except:
+            # already numpy
+            pass
+        self.score_vector = np.asarray(score_vector)
+        self.correct_vector = np.asarray(correct_vector, dtype=float)
+        self.lambdas = np.asarray(lambdas)
+        self.alpha = alpha
+        self.shape = (self.score_vector.shape[0], self.lambdas.shape[0])
+
+    # Supports table[rows] and table[rows, cols] with slices or index arrays.
+    def __getitem__(self, key):
+        rows, cols = key if isinstance(key, tuple) else (key, slice(None))
+        return PFDRLossTable(self.score_vector[rows], self.correct_vector[rows], self.lambdas[cols], self.alpha)
+
+    def __array__(self, dtype=None):
+        loss_table = pfdr_loss_table(self.score_vector, self.correct_vector, self.lambdas, self.alpha)
+        return loss_table if dtype is None else loss_table.astype(dtype)
+
+    # A predicted point contributes 1-c_i, every other point contributes alpha.
+    def mean(self, axis=0):
+        n = self.shape[0]
+        counts, incorrect_sums = sums_above_thresholds(self.score_vector, 1-self.correct_vector, self.lambdas)
+        return (incorrect_sums + self.alpha*(n-counts))/n
+
+    def std(self, axis=0):
+        n = self.shape[0]
+        incorrects = 1-self.correct_vector
+        counts, sums = sums_above_thresholds(self.score_vector, np.stack((incorrects, incorrects**2), axis=1), self.lambdas)
+        means = (sums[:,0] + self.alpha*(n-counts))/n
+        second_moments = (sums[:,1] + self.alpha**2*(n-counts))/n
+        return np.sqrt(np.maximum(second_moments - means**2, 0))
+
+    # es.T @ table[start:start+len(es)]. Row i equals alpha plus (1-c_i-alpha) on the lambdas below s_i,
+    # so with rows sorted by how many sorted lambdas lie below them, column j sums a suffix of the rows.
+    def weighted_row_sums(self, es, start):
+        rows = slice(start, start+es.shape[0])
+        scores = self.score_vector[rows]
+        excesses = 1-self.correct_vector[rows]-self.alpha
+        lambdas = as_score_dtype(self.lambdas, scores)
+        lambda_order = np.argsort(lambdas, kind='stable')
+        num_below = np.searchsorted(lambdas[lambda_order], scores, side='left')
+        order = np.argsort(num_below, kind='stable')
+        cumulative = np.concatenate((np.zeros((1,es.shape[1])), np.cumsum(es[order]*excesses[order,np.newaxis], axis=0)))
+        num_at_most = np.searchsorted(num_below[order], np.arange(self.shape[1]), side='right')
+        sums = np.zeros((es.shape[1],self.shape[1]))
+        sums[:,lambda_order] = (cumulative[-1] - cumulative[num_at_most]).T
+        return sums + self.alpha*es.sum(axis=0)[:,np.newaxis]
+
 """
     RW SPECIALIZATIONS
 """
 
 def pfdr_romano_wolf_multiplier_bootstrap(score_vector, correct_vector, lambdas, alpha, delta, B=100): 
-    n = score_vector.shape[0]
-    N = lambdas.shape[0]
-    loss_table = pfdr_loss_table(score_vector, correct_vector, lambdas, alpha)
-    r_hats = loss_table.mean(axis=0) # empirical risk at each lambda
-    z_table = loss_table - loss_table.mean(axis=0)[np.newaxis,:] # Broadcast so Z_{i,j}=l_{i,j}-mean_i(l_{i,j})
-    es = np.random.random(size=(n,B))
-    cs = np.zeros((B,N))
-    # Bootstrapping
-    for b in range(B):
-        cs[b] = np.mean(z_table * es[:,b:b+1],axis=0)
-    def subset_scoring_function(S):
-        idx = np.array(list(S))
-        subset = cs[:,idx]
-        maxes = np.max(subset,axis=1)
-        return -np.quantile(maxes,1-delta,interpolation='higher') # Weird negative due to flipped sign in romano-wolf algorithm 
-    return romano_wolf(-(alpha-r_hats),subset_scoring_function)
+    loss_table = PFDRLossTable(score_vector, correct_vector, lambdas, alpha)
+    return romano_wolf_multiplier_bootstrap(loss_table, lambdas, alpha, delta, B=B)
 
 # correct_vector_i = 1(top class is correct on example i)
 # score_vector_i = score of top class for example i
 def pfdr_romano_wolf_HB(score_vector,correct_vector,lambdas,alpha,delta):
     nus, rs, n = get_nus_rs_n(score_vector, correct_vector, lambdas)
     r_hats = nus - alpha*rs + alpha
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
+    p_values = hb_p_value(r_hats,n,alpha)
     p_values = np.nan_to_num(p_values, nan=1.0)
-    def subset_scoring_function(S):
-        return delta/len(S)
+    def size_scoring_function(sizes):
+        return delta/sizes
     #return np.nonzero(nus - alpha * rs + alpha < alpha)[0]
-    return romano_wolf(p_values,subset_scoring_function)
+    return romano_wolf_monotone(p_values,size_scoring_function)
 
 """
     BONFERRONI SPECIALIZATIONS 
@@ -84,26 +137,25 @@ def pfdr_romano_wolf_HB(score_vector,correct_vector,lambdas,alpha,delta):
 def pfdr_bonferroni_HB(score_vector,correct_vector,lambdas,alpha,delta):
     nus, rs, n = get_nus_rs_n(score_vector, correct_vector, lambdas)
     r_hats = nus-alpha*rs+alpha
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
+    p_values = hb_p_value(r_hats,n,alpha)
     p_values = np.nan_to_num(p_values, nan=1.0)
     return bonferroni(p_values,delta)
 
+# Vectorized over nu and r.
 def pfdr_ucb_HB(n, nu, r, delta, maxiter):
-    nu_p = HB_mu_plus(nu, n, delta, maxiter)
-    r_m = HB_mu_minus(r, n, delta, maxiter)
-    if r_m <= 0 and nu_p > 0:
-        return np.Inf 
-    if nu_p <= 0:
-        return 0 
-    return nu_p/r_m
+    nu_p = HB_mu_plus_batched(nu, n, delta, maxiter)
+    r_m = HB_mu_minus_batched(r, n, delta, maxiter)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ucb = np.where(r_m <= 0, np.Inf, nu_p/r_m)
+    return np.where(nu_p <= 0, 0.0, ucb)
 
 def pfdr_HB(score_vector, correct_vector, lambdas, alpha, delta, m=1000, maxiter=1000):
     nus, rs, n = get_nus_rs_n(score_vector, correct_vector, lambdas)
     starting_index = (nus/rs < alpha).nonzero()[0][0]
 
-    pfdr_pluses = torch.tensor( [ pfdr_ucb_HB(n, nus[i], rs[i], delta, maxiter) for i in range(starting_index, calib_nu.shape[0]) ] )
+    pfdr_pluses = pfdr_ucb_HB(n, nus[starting_index:], rs[starting_index:], delta, maxiter)
 
-    if ((pfdr_pluses > alpha).float().sum() == 0):
+    if (pfdr_pluses > alpha).sum() == 0:
         valid_set_index = 0
     else:
         valid_set_index = max((pfdr_pluses > alpha).nonzero()[0][0]+starting_index-1, 0)  # -1 because it needs to be <= alpha
@@ -119,21 +171,30 @@ def pfdr_uniform(score_vector,correct_vector,lambdas,alpha,delta,m=1000,maxiter=
     starting_index = (s_arr < alpha).nonzero()[0][0]
     ending_index = (s_arr < alpha).nonzero()[0][-1]
 
-    upper_bounds_arr = np.array([ nu_plus(n, m, s, alpha, delta, maxiter, num_grid_points) for s in s_arr[starting_index:min((ending_index+1),N)] ])
+    upper_bounds_arr = nu_plus_batched(n, m, s_arr[starting_index:min((ending_index+1),N)], alpha, delta, maxiter, num_grid_points)
     R = np.nonzero(upper_bounds_arr < alpha)[0] + starting_index
     return R
 
 """
     BONFERRONI SEARCH SPECIALIZATIONS 
 """
-def pfdr_bonferroni_search_HB(score_vector, correct_vector, lambdas, alpha, delta, downsample_factor=10):
-    nus, rs, n = get_nus_rs_n(score_vector, correct_vector, lambdas)
+# The search runs over the reversed grid; with lazy=True nu, r and the p-value are only computed for the lambdas it visits.
+# The scores are sorted once either way, and the eager path is the default, as for bonferroni_search_HB.
+def pfdr_bonferroni_search_HB(score_vector, correct_vector, lambdas, alpha, delta, downsample_factor=10, lazy=False):
     N = lambdas.shape[0]
-    r_hats = [ nus[i]-alpha*rs[i]+alpha for i in range(len(nus)) ] # using lihua's note, empirical risk at each lambda
-    p_values = np.array([hb_p_value(r_hat,n,alpha) for r_hat in r_hats])
-    p_values = np.nan_to_num(p_values, nan=1.0)
-    p_values[-1] = 0.0
-    R = N-bonferroni_search(p_values[::-1],delta,downsample_factor)-1
+    nus_rs_n = get_nus_rs_n_function(score_vector, correct_vector)
+    def p_value_function(reversed_idxs):
+        idxs = N-reversed_idxs-1
+        nus, rs, n = nus_rs_n(lambdas[idxs])
+        r_hats = nus-alpha*rs+alpha # using lihua's note, empirical risk at each lambda
+        p_values = hb_p_value(r_hats,n,alpha)
+        p_values = np.nan_to_num(p_values, nan=1.0)
+        p_values[idxs == N-1] = 0.0
+        return p_values
+    if lazy:
+        R = N-bonferroni_search_lazy(p_value_function,N,delta,downsample_factor)-1
+    else:
+        R = N-bonferroni_search(p_value_function(np.arange(N)),delta,downsample_factor)-1
     return R 
 
 if __name__ == "__main__":
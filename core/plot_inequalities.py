@@ -1,3 +1,4 @@
+import itertools
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
@@ -21,8 +22,12 @@ def plot_upper_tail(ns,s,ms,delta,maxiter):
     plt.legend()
     plt.savefig('../outputs/shat_upper_tail.pdf')
 
-def plot_required_fdp(ns, m, alphas, deltas, maxiter):
+def plot_required_fdp(ns, m, alphas, deltas, maxiter, num_processes=None):
     sns.set(font_scale=1.5)
+    # Tabulate eta_star over the whole frontier in parallel, unless a table already covers it
+    corners = itertools.product((min(ns),max(ns)), (min(alphas),max(alphas)), (min(deltas),max(deltas)))
+    if any(interpolate_eta_star_upper(n, m, alpha, delta, 100) is None for n, alpha, delta in corners):
+        tabulate_eta_star_upper(ns, [m,], alphas, deltas, num_grid_points=100, num_processes=num_processes)
     columns = ['alpha_plus','n','m','alpha','delta']
     concat_list = []
     # Plot upper tail
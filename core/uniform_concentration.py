@@ -1,31 +1,18 @@
-import os
+import os, sys, itertools
+sys.path.insert(1, os.path.join(os.path.abspath(os.path.dirname(__file__)), '../'))
 import pathlib
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy.stats as stats
 from scipy.optimize import brentq
+from scipy.interpolate import RegularGridInterpolator
+import multiprocessing as mp
 import pdb
 from pathlib import Path
-import pickle as pkl
+from core.utils import cacheable
 
 CACHE = str(Path(__file__).parent.absolute()) + '/.cache/'
 
-def cacheable(func):
-    def cache_func(*args):
-        fname = CACHE + str(func).split(' ')[1] + str(args) + '.pkl'
-        os.makedirs(CACHE, exist_ok=True)
-        try:
-            filehandler = open(fname, 'rb')
-            result = pkl.load(filehandler)
-            return result 
-        except:
-            filehandler = open(fname, 'wb')
-            result = func(*args)
-            pkl.dump(result, filehandler)   
-            return result
-
-    return cache_func
-
 def safe_min(x):
     if np.any(np.isnan(x)):
         return -np.Inf
@@ -37,14 +24,36 @@ def expand_grid(arr1,arr2):
     params = np.meshgrid(arr2,arr1)
     return params[1].T.flatten(), params[0].T.flatten()
 
+# The (gamma, n_p) grid only depends on n, so it is built once per n.
+_vapnik_grids = {}
+
+def vapnik_grid(n):
+    if n not in _vapnik_grids:
+        gamma, n_p = expand_grid(np.arange(0.001, 0.5 + 0.001, 0.001), np.arange(0.5, 3 + 0.1, 0.1))
+        n_p = np.ceil(n**(n_p))
+        _vapnik_grids[n] = (gamma, n_p)
+    return _vapnik_grids[n]
+
+# Solved thresholds t, memoized per (tail, n, m, delta, eta, num_grid_points).
+_vapnik_tails = {}
+
+def _memoized_tail(tail, solve, n, m, delta, eta, num_grid_points):
+    key = (tail, float(n), float(m), float(delta), float(eta), num_grid_points)
+    if key not in _vapnik_tails:
+        _vapnik_tails[key] = solve()
+    return _vapnik_tails[key]
+
 # Get t
 # Equation 12 in Lihua's note 
 def normalized_vapnik_tail_upper(n, m, delta, eta, maxiter,num_grid_points=None):
     c1 = np.log(1 / 4 / (1-stats.norm.cdf(np.sqrt(2))) )
     c2 = 5 * np.sqrt( 2*np.pi*np.exp(1) ) * ( 2*stats.norm.cdf(1) - 1)
+    gamma, n_p = vapnik_grid(n)
+    log_Delta = np.log(m*(n + n_p) + 1)
+    # If the grid is fixed, log_Delta changes.
+    if num_grid_points != None:
+        log_Delta = np.log(num_grid_points)
     def _tailprob(x):
-        gamma, n_p = expand_grid(np.arange(0.001, 0.5 + 0.001, 0.001), np.arange(0.5, 3 + 0.1, 0.1))
-        n_p = np.ceil(n**(n_p))
         kappa = eta + x**2/2 + x*np.sqrt(x**2/4 + eta)
         kappa = eta + (gamma + n/n_p) / (1 + n/n_p) * np.sqrt(kappa) 
         fac1 = 1 - np.exp(-n_p*x**2/2 * gamma**2/(1 + gamma**2*x**2/36/eta))
@@ -52,10 +61,6 @@ def normalized_vapnik_tail_upper(n, m, delta, eta, maxiter,num_grid_points=None)
         log_denom = np.log(np.maximum(0,fac1,fac2))
 
         g2 = n/(1 + n/n_p)**2  * x**2/2 * (1 - gamma)**2/(1 + (1 - gamma)**2 * x**2 / 36 / kappa)
-        log_Delta = np.log(m*(n + n_p) + 1)
-        # If the grid is fixed, log_Delta changes.
-        if num_grid_points != None:
-            log_Delta = np.log(num_grid_points)
         log_prob_bardenet = safe_min(log_Delta - g2 - log_denom)
 
         tmp = np.sqrt(n * (1 + eta)/2) * (1-gamma) * x
@@ -67,26 +72,24 @@ def normalized_vapnik_tail_upper(n, m, delta, eta, maxiter,num_grid_points=None)
         log_prob = np.min([log_prob_bardenet, log_prob_bentkus_dzindzalieta, log_prob_pinelis, log_prob_hoeffding])
         return log_prob - np.log(delta)
 
-    return brentq(_tailprob,0,1,maxiter=maxiter) 
+    return _memoized_tail('upper', lambda: brentq(_tailprob,0,1,maxiter=maxiter), n, m, delta, eta, num_grid_points)
 
 # Equation 11 in Lihua's note.
 def normalized_vapnik_tail_lower(n, m, delta, eta, maxiter, num_grid_points=None):
     c1 = np.log(1 / 4 / (1-stats.norm.cdf(np.sqrt(2))) )
     c2 = 5 * np.sqrt( 2*np.pi*np.exp(1) ) * ( 2*stats.norm.cdf(1) - 1)
+    gamma, n_p = vapnik_grid(n)
+    log_Delta = np.log(m*(n + n_p) + 1)
+    # If the grid is fixed, log_Delta changes.
+    if num_grid_points != None:
+        log_Delta = np.log(num_grid_points)
     def _tailprob(x):
-        gamma, n_p = expand_grid(np.arange(0.001, 0.5 + 0.001, 0.001), np.arange(0.5, 3 + 0.1, 0.1))
-        n_p = np.ceil(n**(n_p))
         kappa_plus = eta + x**2/2 + x*np.sqrt(x**2/4 + eta)
-        kappa_minus = eta + (gamma + n/n_p) / (1 + n/n_p) * np.sqrt(kappa_plus) 
         fac1 = 1 - np.exp(-n_p*x**2/2 * gamma**2/(1 + gamma**2*x**2/36/kappa_plus))
         fac2 = 1 - (np.sqrt(1+kappa_plus) - np.sqrt(kappa_plus))**2 / (n_p * x**2 * gamma**2)
         log_denom = np.log(np.maximum(0,fac1,fac2))
 
         g2 = n/(1 + n/n_p)**2  * x**2/2 * (1 - gamma)**2/(1 + (1 - gamma)**2 * x**2 / 36 / eta)
-        log_Delta = np.log(m*(n + n_p) + 1)
-        # If the grid is fixed, log_Delta changes.
-        if num_grid_points != None:
-            log_Delta = np.log(num_grid_points)
         log_prob_bardenet = safe_min(log_Delta - g2 - log_denom)
 
         tmp = np.sqrt(n * (1 + eta)/2) * (1-gamma) * x
@@ -98,7 +101,7 @@ def normalized_vapnik_tail_lower(n, m, delta, eta, maxiter, num_grid_points=None
         log_prob = np.min([log_prob_bardenet, log_prob_bentkus_dzindzalieta, log_prob_pinelis, log_prob_hoeffding])
         return log_prob - np.log(delta)
 
-    return brentq(_tailprob,0,1,maxiter=maxiter) 
+    return _memoized_tail('lower', lambda: brentq(_tailprob,0,1,maxiter=maxiter), n, m, delta, eta, num_grid_points)
 
 # Return upper bound fdr
 def shat_upper_tail(s, n, m, delta, eta, maxiter, num_grid_points=None):
@@ -120,9 +123,14 @@ def shat_lower_tail(s, n, m, delta, eta, maxiter, num_grid_points=None):
     return shat
 
 # General upper and lower bounds
-@cacheable
+# The cached parts are keyed on the eta_star actually used rather than on alpha, so bounds cached before an
+# eta_star table was built (or rebuilt) are not mixed with the bounds it gives.
 def nu_plus(n, m, nu, alpha, delta, maxiter, num_grid_points):
     eta_star = get_eta_star_upper(n, m, alpha, delta, 20, num_grid_points=num_grid_points)
+    return _nu_plus(n, m, nu, eta_star, delta, maxiter, num_grid_points)
+
+@cacheable
+def _nu_plus(n, m, nu, eta_star, delta, maxiter, num_grid_points):
     t = normalized_vapnik_tail_upper(n, m, delta, eta_star, maxiter, num_grid_points=num_grid_points)
     try:
         nu_plus = nu + t*np.sqrt(nu + eta_star + (t*t)/4) + (t*t)/2 
@@ -132,44 +140,112 @@ def nu_plus(n, m, nu, alpha, delta, maxiter, num_grid_points):
         nu_plus = 1 
     return nu_plus 
 
-# The empirical risk required to get an upper bound of b
+# nu_plus for an array of nus; t only depends on (n, m, delta, eta_star), so there is a single root solve.
+def nu_plus_batched(n, m, nus, alpha, delta, maxiter, num_grid_points):
+    eta_star = get_eta_star_upper(n, m, alpha, delta, 20, num_grid_points=num_grid_points)
+    t = normalized_vapnik_tail_upper(n, m, delta, eta_star, maxiter, num_grid_points=num_grid_points)
+    nus = np.asarray(nus, dtype=float)
+    with np.errstate(invalid='ignore'):
+        nu_pluses = nus + t*np.sqrt(nus + eta_star + (t*t)/4) + (t*t)/2 
+    return np.clip(nu_pluses,0,1)
+
+# The empirical risk required to get an upper bound of b (vectorized over b)
+# With t and eta_star fixed, nu_plus(er) = er + t*sqrt(er + eta_star + t^2/4) + t^2/2 is increasing in er,
+# and solving the quadratic in sqrt(er + eta_star + t^2/4) gives er = b - t*sqrt(b + eta_star).
 def required_empirical_risk(b, n, m, alpha, delta, maxiter, num_grid_points):
-    def _condition(er):
-        return (nu_plus(n, m, er, alpha, delta, maxiter, num_grid_points) - b)
     try:
-        return brentq(_condition, 0, 1, maxiter=maxiter)
+        eta_star = get_eta_star_upper(n, m, alpha, delta, 20, num_grid_points=num_grid_points)
+        t = normalized_vapnik_tail_upper(n, m, delta, eta_star, maxiter, num_grid_points=num_grid_points)
     except:
-        return 0
+        return np.zeros_like(b, dtype=float)
+    return np.maximum(b - t*np.sqrt(b + eta_star), 0)
 
-@cacheable
 def r_minus(n, m, r, alpha, delta, maxiter, num_grid_points):
     eta_star = get_eta_star_upper(n, m, alpha, delta, 20, num_grid_points=num_grid_points)
+    return _r_minus(n, m, r, eta_star, delta, maxiter, num_grid_points)
+
+@cacheable
+def _r_minus(n, m, r, eta_star, delta, maxiter, num_grid_points):
     t2 = normalized_vapnik_tail_lower(n, m, delta, eta_star, maxiter, num_grid_points=num_grid_points)
     r_minus = r - t2*np.sqrt(max(r+eta_star, 0))
     return r_minus 
 
+# Optimal eta for the upper tail, scanning a log grid of etas
+def compute_eta_star_upper(n, m, alpha, delta, maxiter=20, num_grid_points=None):
+    eta_grid = np.logspace(-20,1,50)
+    ts = np.full_like(eta_grid, np.nan)
+    for k in range(eta_grid.shape[0]):
+        try:
+            ts[k] = normalized_vapnik_tail_upper(n, m, delta, eta_grid[k], maxiter, num_grid_points=num_grid_points)
+        except:
+            pass
+    xs = alpha - ts*np.sqrt(alpha + eta_grid)
+    valid = xs >= 0 # ties go to the largest eta, failed searches are skipped
+    if not valid.any():
+        return 1.0
+    return eta_grid[np.nonzero(valid & (xs == xs[valid].max()))[0][-1]]
+
+def eta_star_table_path(num_grid_points=None):
+    return CACHE + f'eta_star_table_{num_grid_points}.npz'
+
+# Precomputes eta_star over the grid ns x ms x alphas x deltas with a process pool and saves it as one indexed array file.
+def tabulate_eta_star_upper(ns, ms, alphas, deltas, maxiter=20, num_grid_points=None, num_processes=None):
+    ns, ms, alphas, deltas = [np.sort(np.asarray(axis, dtype=float)) for axis in (ns, ms, alphas, deltas)]
+    params = [(n, m, alpha, delta, maxiter, num_grid_points) for n, m, alpha, delta in itertools.product(ns, ms, alphas, deltas)]
+    with mp.Pool(num_processes) as pool:
+        eta_stars = pool.starmap(compute_eta_star_upper, params)
+    eta_stars = np.array(eta_stars).reshape((ns.shape[0], ms.shape[0], alphas.shape[0], deltas.shape[0]))
+    os.makedirs(CACHE, exist_ok=True)
+    fpath = eta_star_table_path(num_grid_points)
+    tmp_fpath = fpath + f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp_fpath, ns=ns, ms=ms, alphas=alphas, deltas=deltas, eta_stars=eta_stars)
+    os.replace(tmp_fpath, fpath)
+    _eta_star_interpolators.pop(num_grid_points, None)
+    return eta_stars
+
+_eta_star_interpolators = {}
+
+# Interpolates log(eta_star) linearly in (log n, log m, alpha, delta); None if there is no table or the query is outside it.
+# An axis with a single point (e.g. one m) cannot be interpolated along, so it is left out of the interpolator and the
+# query must match it exactly. A missing table is remembered as None until tabulate_eta_star_upper writes one.
+def interpolate_eta_star_upper(n, m, alpha, delta, num_grid_points=None):
+    if num_grid_points not in _eta_star_interpolators:
+        try:
+            table = np.load(eta_star_table_path(num_grid_points))
+        except FileNotFoundError:
+            _eta_star_interpolators[num_grid_points] = None
+            return None
+        axes = (np.log(table['ns']), np.log(table['ms']), table['alphas'], table['deltas'])
+        grid_axes = [ k for k in range(len(axes)) if axes[k].shape[0] > 1 ]
+        point_axes = [ k for k in range(len(axes)) if axes[k].shape[0] == 1 ]
+        log_eta_stars = np.log(table['eta_stars']).reshape([ axes[k].shape[0] for k in grid_axes ])
+        interpolator = RegularGridInterpolator([ axes[k] for k in grid_axes ], log_eta_stars, bounds_error=False, fill_value=np.nan) if len(grid_axes) > 0 else None
+        _eta_star_interpolators[num_grid_points] = (interpolator, grid_axes, { k: axes[k][0] for k in point_axes }, log_eta_stars)
+    if _eta_star_interpolators[num_grid_points] is None:
+        return None
+    interpolator, grid_axes, points, log_eta_stars = _eta_star_interpolators[num_grid_points]
+    query = (np.log(n), np.log(m), alpha, delta)
+    if not all(np.isclose(query[k], point) for k, point in points.items()):
+        return None
+    log_eta_star = interpolator([[ query[k] for k in grid_axes ]])[0] if interpolator is not None else log_eta_stars.item()
+    if np.isnan(log_eta_star):
+        return None
+    return np.exp(log_eta_star)
+
 # Get optimal eta for upper tail
 def get_eta_star_upper(n, m, alpha, delta, maxiter, num_grid_points=None):
+    eta_star = interpolate_eta_star_upper(n, m, alpha, delta, num_grid_points)
+    if eta_star is not None:
+        return eta_star
     alpha = np.round(alpha,2)
-    delta = np.round(alpha,2)
-    fname = f'eta_star_{n}_{alpha:.2f}_{delta:.2f}'
+    delta = np.round(delta,2)
+    fname = f'eta_star_{n}_{m}_{alpha:.2f}_{delta:.2f}_{num_grid_points}'
     fpath = CACHE+fname+'.npy'
     if os.path.exists( fpath ):
         eta_star = np.load( fpath )
     else:
-        print(f"Computing eta_star for {n}, {alpha:.2f}, {delta:.2f}")
-        eta_grid = np.logspace(-20,1,50)
-        best_x = 0
-        eta_star = 1
-        for eta in eta_grid:
-            try:
-                t = normalized_vapnik_tail_upper(n, m, delta, eta, 20, num_grid_points=num_grid_points)
-                x = alpha - t*np.sqrt(alpha + eta) 
-                if x >= best_x:
-                    best_x = x
-                    eta_star = eta
-            except:
-                pass
+        print(f"Computing eta_star for {n}, {m}, {alpha:.2f}, {delta:.2f}")
+        eta_star = compute_eta_star_upper(n, m, alpha, delta, 20, num_grid_points=num_grid_points)
         print(f"ETA STAR: {eta_star}")
         os.makedirs(CACHE, exist_ok=True)
         np.save( fpath, eta_star )
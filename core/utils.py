@@ -1,20 +1,141 @@
 import os
+import time
+import sqlite3
+import hashlib
+import inspect
+import functools
 import pathlib
 import pickle as pkl
+from collections import OrderedDict
+import numpy as np
 
-def cacheable(func):
-    def cache_func(*args):
-        fname = str(pathlib.Path(__file__).parent.absolute()) + '/.cache/' + str(func).split(' ')[1] + str(args) + '.pkl'
-        os.makedirs('./.cache/', exist_ok=True)
-        if os.path.exists(fname):
-            filehandler = open(fname, 'rb')
-            return pkl.load(filehandler)    
-        else:
-            filehandler = open(fname, 'wb')
-            result = func(*args)
-            pkl.dump(result, filehandler)   
-            return result
+CACHE = str(pathlib.Path(__file__).parent.absolute()) + '/.cache/'
+
+"""
+    LOCAL CACHE STORE
+"""
+# Two tiers: an in-memory LRU per process, backed by a single SQLite file on disk.
+# SQLite gives atomic writes and file locking, so forked workers can share the store safely.
+# The disk tier is evicted least-recently-used first once it grows past max_disk_bytes.
+class CacheStore(object):
+    def __init__(self, path, max_memory_items=10000, max_disk_bytes=2**30, eviction_interval=100):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_bytes = max_disk_bytes
+        self.eviction_interval = eviction_interval
+        self.memory = OrderedDict()
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._connection = None
+        self._pid = None
+        self._num_writes = 0
+
+    # Connections must not cross a fork, so each process opens its own.
+    def connection(self):
+        if self._connection is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=600, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, accessed REAL)')
+            self._pid = os.getpid()
+        return self._connection
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    # Returns (True, value) on a hit and (False, None) on a miss.
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.counters['memory_hits'] += 1
+            return True, self.memory[key]
+        connection = self.connection()
+        row = connection.execute('SELECT value FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.counters['misses'] += 1
+            return False, None
+        connection.execute('UPDATE entries SET accessed = ? WHERE key = ?', (time.time(), key))
+        value = pkl.loads(row[0])
+        self._remember(key, value)
+        self.counters['disk_hits'] += 1
+        return True, value
+
+    def set(self, key, value):
+        self._remember(key, value)
+        blob = pkl.dumps(value, protocol=pkl.HIGHEST_PROTOCOL)
+        connection = self.connection()
+        connection.execute('INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)', (key, blob, len(blob), time.time()))
+        self._num_writes += 1
+        if self._num_writes % self.eviction_interval == 0:
+            self.evict()
+
+    def evict(self):
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            total_size = connection.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+            if total_size > self.max_disk_bytes:
+                stale_keys = []
+                for key, size in connection.execute('SELECT key, size FROM entries ORDER BY accessed ASC'):
+                    if total_size <= self.max_disk_bytes:
+                        break
+                    stale_keys.append((key,))
+                    total_size -= size
+                connection.executemany('DELETE FROM entries WHERE key = ?', stale_keys)
+            connection.execute('COMMIT')
+        except:
+            connection.execute('ROLLBACK')
+            raise
 
+    def clear(self):
+        self.memory.clear()
+        self.connection().execute('DELETE FROM entries')
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['memory_items'] = len(self.memory)
+        stats['disk_items'], stats['disk_bytes'] = self.connection().execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return stats
+
+# Arguments are normalized so that e.g. np.float64(0.1) and 0.1 hash the same, then hashed with sha256.
+def _normalize_argument(arg):
+    if isinstance(arg, np.ndarray):
+        return ('ndarray', str(arg.dtype), arg.shape, hashlib.sha256(np.ascontiguousarray(arg).tobytes()).hexdigest())
+    if isinstance(arg, np.generic):
+        return arg.item()
+    if isinstance(arg, (list, tuple)):
+        return tuple(_normalize_argument(a) for a in arg)
+    if isinstance(arg, dict):
+        return tuple(sorted((k, _normalize_argument(v)) for k, v in arg.items()))
+    return arg
+
+# The call is bound to func's signature with defaults applied, so f(a, b), f(a, b=b) and f(a) with b
+# defaulted all hash the same.
+def cache_key(func, args, kwargs={}):
+    try:
+        bound = inspect.signature(func).bind(*args, **kwargs)
+        bound.apply_defaults()
+        arguments = tuple(bound.arguments.items())
+    except (TypeError, ValueError):
+        # no signature or a call that does not bind, which func itself will reject
+        arguments = (args, kwargs)
+    normalized = (func.__module__, func.__qualname__, _normalize_argument(arguments))
+    return hashlib.sha256(repr(normalized).encode()).hexdigest()
+
+CACHE_STORE = CacheStore(CACHE + 'cache.sqlite')
+
+def cacheable(func):
+    @functools.wraps(func)
+    def cache_func(*args, **kwargs):
+        key = cache_key(func, args, kwargs)
+        hit, result = CACHE_STORE.get(key)
+        if not hit:
+            result = func(*args, **kwargs)
+            CACHE_STORE.set(key, result)
+        return result
+    cache_func.cache_store = CACHE_STORE
     return cache_func
 
 if __name__=="__main__":
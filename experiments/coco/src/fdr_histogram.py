@@ -17,7 +17,7 @@ import pickle as pkl
 from tqdm import tqdm
 from utils import *
 import seaborn as sns
-from core.concentration import oracle_HB, romano_wolf_multiplier_bootstrap, romano_wolf_HB, bonferroni_HB, bonferroni_search_HB, multiscale_bonferroni_search_HB, uniform_region
+from core.concentration import oracle_HB, romano_wolf_multiplier_bootstrap, romano_wolf_HB, bonferroni_HB, bonferroni_search_HB, multiscale_bonferroni_search_HB, uniform_region, split_selections, bonferroni_HB_batched, bonferroni_search_HB_batched
 import pdb
 
 parser = argparse.ArgumentParser(description='ASL MS-COCO predictor')
@@ -106,6 +106,27 @@ def trial_precomputed(rejection_region_function, rejection_region_name, example_
 
     return fdrs.mean(), torch.tensor(sizes), float(lhat)
 
+# The batched counterpart of trial_precomputed for methods that only look at the calibration risks: the splits of
+# all trials are drawn at once from np.random.default_rng(seed) as 0/1 selections, the calibration risks are one
+# matrix product, and the validation fdr and sizes are read off the unselected rows. Returns (fdr, sizes, lhat) per trial.
+def trials_batched(batched_rejection_region_function, example_loss_table, example_size_table, lambdas_example_table, alpha, delta, num_calib, num_trials, seed=0):
+    # Big lambda = Big loss
+    example_loss_table = example_loss_table[:,::-1]
+    example_size_table = example_size_table[:,::-1]
+    selections = split_selections(example_loss_table.shape[0], num_calib, num_trials, rng=np.random.default_rng(seed))
+    cal_risks = selections @ example_loss_table / num_calib
+    rejections = batched_rejection_region_function(cal_risks, num_calib, alpha, delta)
+    results = []
+    for i in range(num_trials):
+        R = np.nonzero(rejections[i])[0]
+        # Pick the largest set
+        if len(R) == 0:
+            results = results + [(None, None, -1.0),]
+            continue
+        val_rows = selections[i] == 0
+        results = results + [(example_loss_table[val_rows,R.max()].mean(), torch.tensor(example_size_table[val_rows,R.max()]), float(lambdas_example_table[R.max()])),]
+    return results
+
 def table_function(sizes_array,labels):
     strng = ""
     for i in range(len(labels)):
@@ -152,7 +173,8 @@ def plot_histograms(df_list,alpha,delta):
     n = table_file.write(table_string)
     table_file.close()
 
-def experiment(rejection_region_functions,rejection_region_names,alpha,delta,num_lam,num_calib,lambdas_example_table,num_trials,coco_val_2017_directory,coco_instances_val_2017_json):
+# Methods with a batched counterpart (not None) run all trials at once; the rest run one trial at a time.
+def experiment(rejection_region_functions,batched_rejection_region_functions,rejection_region_names,alpha,delta,num_lam,num_calib,lambdas_example_table,num_trials,coco_val_2017_directory,coco_instances_val_2017_json):
     df_list = []
 
     for idx in range(len(rejection_region_functions)):
@@ -195,8 +217,11 @@ def experiment(rejection_region_functions,rejection_region_names,alpha,delta,num
             m = scores.shape[1]
             
             local_df_list = []
-            for i in tqdm(range(num_trials)):
-                fdr, sizes, lhat = trial_precomputed(rejection_region_function, rejection_region_name, example_fdr_table, example_size_table, lambdas_example_table, alpha, delta, num_lam, num_calib, m)
+            if batched_rejection_region_functions[idx] is not None:
+                trial_results = trials_batched(batched_rejection_region_functions[idx], example_fdr_table, example_size_table, lambdas_example_table, alpha, delta, num_calib, num_trials)
+            else:
+                trial_results = ( trial_precomputed(rejection_region_function, rejection_region_name, example_fdr_table, example_size_table, lambdas_example_table, alpha, delta, num_lam, num_calib, m) for i in tqdm(range(num_trials)) )
+            for fdr, sizes, lhat in trial_results:
                 if lhat < 0:
                     continue
                 dict_local = {"$\\hat{\\lambda}$": lhat,
@@ -250,11 +275,20 @@ if __name__ == "__main__":
         def _multiscale_bonferroni_search_HB(loss_table,lambdas,alpha,delta):
             return multiscale_bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor=loss_table.shape[1])
 
+        # local function to preserve template
+        def _bonferroni_search_HB_J1_batched(cal_risks,n,alpha,delta):
+            return bonferroni_search_HB_batched(cal_risks,n,alpha,delta,downsample_factor=cal_risks.shape[1])
+
+        # local function to preserve template
+        def _bonferroni_search_HB_batched(cal_risks,n,alpha,delta):
+            return bonferroni_search_HB_batched(cal_risks,n,alpha,delta,downsample_factor=10)
+
         rejection_region_functions = ( uniform_region, bonferroni_HB, _bonferroni_search_HB, _bonferroni_search_HB_J1 )
+        batched_rejection_region_functions = ( None, bonferroni_HB_batched, _bonferroni_search_HB_batched, _bonferroni_search_HB_J1_batched )
         #rejection_region_functions = ( uniform_region, bonferroni_HB, _bonferroni_search_HB, _bonferroni_search_HB_J1, romano_wolf_multiplier_bootstrap )
         rejection_region_names = ( 'Uniform', 'Bonferroni', 'Fixed Sequence\n(Multi-Start)', 'Fixed Sequence' )
         #rejection_region_names = ( 'Uniform', 'Bonferroni', 'Fixed Sequence\n(Multi-Start)', 'Fixed Sequence', 'Multiplier\nBootstrap' )
         
         for alpha, delta in params:
             print(f"\n\n\n ============           NEW EXPERIMENT alpha={alpha} delta={delta}           ============ \n\n\n") 
-            experiment(rejection_region_functions,rejection_region_names,alpha,delta,num_lam,num_calib,lambdas_example_table,num_trials,coco_val_2017_directory,coco_instances_val_2017_json)
+            experiment(rejection_region_functions,batched_rejection_region_functions,rejection_region_names,alpha,delta,num_lam,num_calib,lambdas_example_table,num_trials,coco_val_2017_directory,coco_instances_val_2017_json)
@@ -52,7 +52,15 @@ def fast_rcnn_inference(
         )
         for scores_per_image, boxes_per_image, image_shape in zip(scores, boxes, image_shapes)
     ]
-    return [x[0] for x in result_per_image], [x[1] for x in result_per_image]
+    instances = [x[0] for x in result_per_image]
+
+    # Construct prediction sets for the detections of every image at once
+    num_detections = [x.softmax_outputs.shape[0] for x in instances]
+    pred_sets, class_ordering = aps_prediction_sets(torch.cat([x.softmax_outputs for x in instances], dim=0), aps_thresh)
+    for result, pred_sets_per_image, class_ordering_per_image in zip(instances, pred_sets.split(num_detections), class_ordering.split(num_detections)):
+        result.pred_sets = pred_sets_per_image
+        result.class_ordering = class_ordering_per_image
+    return instances, [x[1] for x in result_per_image]
 
 
 def fast_rcnn_inference_single_image(
@@ -71,7 +79,8 @@ def fast_rcnn_inference_single_image(
         Same as `fast_rcnn_inference`, but with boxes, scores, and image shapes
         per image.
     Returns:
-        Same as `fast_rcnn_inference`, but for only one image.
+        Same as `fast_rcnn_inference`, but for only one image, without the `pred_sets` and
+        `class_ordering` fields, which `fast_rcnn_inference` fills in for the whole batch.
     """
     valid_mask = torch.isfinite(boxes).all(dim=1) & torch.isfinite(scores).all(dim=1)
     if not valid_mask.all():
@@ -100,8 +109,6 @@ def fast_rcnn_inference_single_image(
         result.pred_boxes = Boxes(boxes[0:0,0,:])
         result.scores = scores
         result.pred_classes = scores[:,0].long()
-        result.pred_sets = scores.bool()
-        result.class_ordering = scores.long()
         result.softmax_outputs = scores
         return result, filter_inds[:, 0]
 
@@ -124,29 +131,22 @@ def fast_rcnn_inference_single_image(
     result.scores = top_scores
     result.pred_classes = filter_inds[:, 1]
 
-    # Construct prediction sets
+    # Normalize the class scores for the prediction sets
     scores = scores/scores.sum(dim=1).unsqueeze(dim=1)
-    sortd, pi = scores.sort(dim=1, descending=True)
-    cumsum = sortd.cumsum(dim=1)
-    try:
-        sizes = (cumsum > aps_thresh).int().argmax(dim=1) + 1
-        sizes[sizes == 0] = 1 # Size at least 1
-    except:
-        sizes = torch.tensor([]) 
-    # The prediction set will be a float to be compatible with the inbuilt detectron2 code.
-    try:
-        result.pred_sets = torch.cat([ to_set_mask(pi[i][0:sizes[i]], scores.shape[1]) for i in range(sizes.shape[0]) ], dim=0)
-    except:
-        result.pred_sets = torch.tensor([])
-    result.class_ordering = pi 
     result.softmax_outputs = scores
 
     return result, filter_inds[:, 0]
 
-def to_set_mask(pset, num_classes):
-    pset_return = torch.zeros((num_classes,))
-    pset_return[pset] = 1
-    return pset_return.unsqueeze(dim=0) > 0 
+# Adaptive prediction sets for R detections with normalized class scores (R x K): each set holds the top classes
+# until their cumulative score exceeds aps_thresh (at least one). The sets are one scatter of the in-set
+# indicator over the class ordering pi. Returns the R x K boolean set masks and pi.
+def aps_prediction_sets(scores, aps_thresh):
+    sortd, pi = scores.sort(dim=1, descending=True)
+    cumsum = sortd.cumsum(dim=1)
+    sizes = (cumsum > aps_thresh).int().argmax(dim=1) + 1
+    in_set = torch.arange(scores.shape[1], device=scores.device).unsqueeze(dim=0) < sizes.unsqueeze(dim=1)
+    pred_sets = torch.zeros(scores.shape, dtype=torch.bool, device=scores.device).scatter_(1, pi, in_set)
+    return pred_sets, pi
 
 class UQFastRCNNOutputLayers(FastRCNNOutputLayers):
     """
@@ -9,7 +9,9 @@ setup_logger()
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
-import os, json, cv2, random, sys, traceback
+import os, json, cv2, random, sys, traceback, argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import skimage.io as io
 
 # import some common detectron2 utilities
@@ -24,13 +26,76 @@ import pickle as pkl
 
 try:
     from .UQHeads import UQHeads
+    from .detection_cache import DetectionCacheWriter
 except:
     from UQHeads import UQHeads
+    from detection_cache import DetectionCacheWriter
 
-import pdb
 from tqdm import tqdm
 
-def cache_data():
+# Reads and decodes one image with its gt masks. Images without usable annotations are not cached, so they come
+# back as None before they cost a forward pass.
+def load_image(cocoGt, label_map, dataDir, dataType, img_id):
+    img_metadata = cocoGt.loadImgs(img_id)[0]
+    img = io.imread('%s/%s/%s'%(dataDir,dataType,img_metadata['file_name']))
+    if len(img.shape) < 3:
+        img = img[:,:,None]
+
+    ann_ids = cocoGt.getAnnIds(imgIds=[img_id,])
+    anns = cocoGt.loadAnns(ann_ids)
+    gt_masks_singleimage = []
+    for ann in anns:
+        try:
+            rleobj = maskUtils.frPyObjects([ann['segmentation'][0]],img_metadata['height'],img_metadata['width'])
+        except (KeyError, TypeError, IndexError):
+            rleobj = maskUtils.frPyObjects([ann['segmentation']],img_metadata['height'],img_metadata['width'])
+        gt_masks_singleimage = gt_masks_singleimage + [maskUtils.decode(rleobj),]
+    if len(gt_masks_singleimage) == 0:
+        return img_id, None, None, None
+    gt_masks_singleimage = torch.tensor(np.concatenate(gt_masks_singleimage,axis=2)).permute(2,0,1).cpu()
+    gt_classes_singleimage = torch.tensor([label_map[ann['category_id']] for ann in anns]).cpu()
+    return img_id, img, gt_classes_singleimage, gt_masks_singleimage
+
+# Yields fn(item) in order while keeping at most window calls in flight, so decoded images never pile up in memory.
+def prefetch(pool, fn, items, window):
+    futures = deque()
+    for item in items:
+        futures.append(pool.submit(fn, item))
+        if len(futures) >= window:
+            yield futures.popleft().result()
+    while len(futures) > 0:
+        yield futures.popleft().result()
+
+# DefaultPredictor.__call__ for a list of images. Batched inference pads the images to a common size, so outputs can
+# differ in the last bits from one image at a time; batch_size=1 reproduces DefaultPredictor exactly.
+def predict_batch(predictor, images):
+    inputs = []
+    for original_image in images:
+        if predictor.input_format == "RGB":
+            original_image = original_image[:, :, ::-1]
+        height, width = original_image.shape[:2]
+        image = predictor.aug.get_transform(original_image).apply_image(original_image)
+        image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+        inputs = inputs + [{"image": image, "height": height, "width": width},]
+    return predictor.model(inputs)
+
+# Runs a batch, falling back to one image at a time if it fails so a single bad image only loses itself.
+# Returns the outputs (None for failed images) and the ids of the failed images.
+def predict_or_skip(predictor, batch):
+    try:
+        return predict_batch(predictor, [img for _, img, _, _ in batch]), []
+    except Exception:
+        if len(batch) > 1:
+            results = [ predict_or_skip(predictor, [item,]) for item in batch ]
+            return [ outputs[0] for outputs, _ in results ], [ img_id for _, failed in results for img_id in failed ]
+        traceback.print_exc()
+        print(f"Image {batch[0][0]} didn't work.")
+        return [None,], [batch[0][0],]
+
+# Streams the val set through the predictor: a thread pool decodes images ahead of the model, the model sees
+# batch_size images at a time, and every chunk_size source images the cache is committed to disk. With resume=True a
+# crashed run picks up after the last committed chunk.
+def cache_data(batch_size=8, num_workers=8, chunk_size=100, resume=True):
     with torch.no_grad():
         # Evaluations
         annType = ['segm','bbox','keypoints']
@@ -55,75 +120,50 @@ def cache_data():
         cfg.MODEL.WEIGHTS = model_zoo.get_checkpoint_url("COCO-InstanceSegmentation/mask_rcnn_R_50_FPN_3x.yaml")
         predictor = DefaultPredictor(cfg)
 
-        # get all images and annotations 
-        pred_classes = []
-        pred_masks = []
-        pred_roi_masks = []
-        pred_boxes = []
-        pred_sets = []
-        pred_softmax_outputs = []
-        gt_classes = []
-        gt_masks = []
-        for img_id in tqdm(cocoGt.imgs):
-            img_metadata = cocoGt.loadImgs(img_id)[0]
-            img = io.imread('%s/%s/%s'%(dataDir,dataType,img_metadata['file_name']))
-            if len(img.shape) < 3:
-                img = img[:,:,None]
-
-            ann_ids = cocoGt.getAnnIds(imgIds=[img_id,])
-            anns = cocoGt.loadAnns(ann_ids)
-            try:
-                outputs = predictor(img)
-            except:
-                extype, value, tb = sys.exc_info()
-                traceback.print_exc()
-                pdb.post_mortem(tb)
-                print(f"Image {img_id} didn't work.")
-                continue
-            
-            gt_masks_singleimage = []
-            for ann in anns:
-                try:
-                    rleobj = maskUtils.frPyObjects([ann['segmentation'][0]],img_metadata['height'],img_metadata['width'])
-                except:
-                    rleobj = maskUtils.frPyObjects([ann['segmentation']],img_metadata['height'],img_metadata['width'])
-                gt_masks_singleimage = gt_masks_singleimage + [maskUtils.decode(rleobj),]
-            try:
-                gt_masks_singleimage = torch.tensor(np.concatenate(gt_masks_singleimage,axis=2)).permute(2,0,1).cpu()
-            except:
-                continue
-
-            # Ensure everything is on cpu
-            outputs['instances'].roi_masks.tensor = outputs['instances'].roi_masks.tensor.cpu()
-            outputs['instances'].pred_boxes.tensor = outputs['instances'].pred_boxes.tensor.cpu()
-            pred_classes = pred_classes + [outputs['instances'].pred_classes.cpu(),]
-            pred_roi_masks = pred_roi_masks + [outputs['instances'].roi_masks,]
-            pred_masks = pred_masks + [outputs['instances'].pred_masks.cpu(),]
-            pred_boxes = pred_boxes + [outputs['instances'].pred_boxes,]
-            pred_sets = pred_sets + [outputs['instances'].pred_sets,]
-            pred_softmax_outputs = pred_softmax_outputs + [outputs['instances'].softmax_outputs.cpu(),]
-            gt_classes = gt_classes + [torch.tensor([label_map[ann['category_id']] for ann in anns]).cpu(),]
-            gt_masks = gt_masks + [gt_masks_singleimage,]
-            #    threshold=0.5
-            #    outputs["instances"].pred_masks = pred_roi_masks[-1].to_bitmasks(pred_boxes[-1],img.shape[0],img.shape[1],threshold).tensor
-            #    break
-        
-	# Save cache
-        os.makedirs('./.cache/', exist_ok=True)  
-        with open('./.cache/boxes.pkl', 'wb') as f:
-            pkl.dump(pred_boxes, f)
-
-        with open('./.cache/roi_masks.pkl', 'wb') as f:
-            pkl.dump(pred_roi_masks, f)
-
-        with open('./.cache/softmax.pkl', 'wb') as f:
-            pkl.dump(pred_softmax_outputs, f)
-
-        with open('./.cache/gt_classes.pkl', 'wb') as f:
-            pkl.dump(gt_classes, f)
+        # get all images and annotations, committed to the columnar cache chunk by chunk
+        img_ids = list(cocoGt.imgs)
+        writer = DetectionCacheWriter(resume=resume)
+        num_processed = writer.num_processed
+        if num_processed > 0:
+            print(f"Resuming after {num_processed} images.")
+        load = lambda img_id: load_image(cocoGt, label_map, dataDir, dataType, img_id)
+        with ThreadPoolExecutor(num_workers) as pool:
+            loaded = prefetch(pool, load, img_ids[num_processed:], window=2*batch_size+num_workers)
+            progress = tqdm(total=len(img_ids), initial=num_processed)
+            batch, failed_ids = [], []
+            for item in loaded:
+                batch = batch + [item,]
+                chunk_done = (num_processed + len(batch)) % chunk_size == 0
+                if len(batch) < batch_size and not chunk_done and num_processed + len(batch) < len(img_ids):
+                    continue
+                to_predict = [ b for b in batch if b[1] is not None ]
+                if len(to_predict) > 0:
+                    outputs, failed = predict_or_skip(predictor, to_predict)
+                    failed_ids = failed_ids + failed
+                    for (img_id, img, gt_classes_singleimage, gt_masks_singleimage), output in zip(to_predict, outputs):
+                        if output is None:
+                            continue
+                        # Ensure everything is on cpu
+                        instances = output['instances']
+                        instances.roi_masks.tensor = instances.roi_masks.tensor.cpu()
+                        instances.pred_boxes.tensor = instances.pred_boxes.tensor.cpu()
+                        writer.append(instances.pred_boxes, instances.roi_masks, instances.softmax_outputs.cpu(), gt_classes_singleimage, gt_masks_singleimage, img_id)
+                num_processed = num_processed + len(batch)
+                progress.update(len(batch))
+                batch = []
+                if chunk_done:
+                    writer.commit(num_processed, failed_ids)
+                    failed_ids = []
+            progress.close()
 
-        with open('./.cache/gt_masks.pkl', 'wb') as f:
-            pkl.dump(gt_masks, f)
+        # Save cache
+        writer.close(num_processed, failed_ids)
 
 if __name__ == "__main__":
-    cache_data()
+    parser = argparse.ArgumentParser(description='Cache the detector outputs on COCO val')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--chunk_size', type=int, default=100)
+    parser.add_argument('--restart', action='store_true', help='ignore any committed chunks and start over')
+    args = parser.parse_args()
+    cache_data(args.batch_size, args.num_workers, args.chunk_size, not args.restart)
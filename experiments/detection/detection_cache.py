@@ -0,0 +1,200 @@
+import numpy as np
+import torch
+import os, json, argparse, hashlib
+import pickle as pkl
+from tqdm import tqdm
+
+# Columnar cache of the detector outputs: one flat binary file per field, concatenated over images, with per-image
+# offsets in index.npz. Readers memory-map the files and only look at committed images, so a worker only pages in
+# the images it touches.
+# gt masks are stored as run lengths over the column-major (COCO order) flattened mask, starting with a run of zeros.
+DETECTION_CACHE = './.cache/detections/'
+FIELDS = { 'boxes': np.float32, 'roi_masks': np.float32, 'softmax': np.float32, 'gt_classes': np.int64, 'gt_mask_runs': np.uint32 }
+
+def encode_mask_runs(mask):
+    flat = np.asarray(mask).astype(bool).flatten(order='F')
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    runs = np.diff(np.concatenate(([0], changes, [flat.size])))
+    if flat.size > 0 and flat[0]:
+        runs = np.concatenate(([0], runs))
+    return runs.astype(np.uint32)
+
+def decode_mask_runs(runs, height, width):
+    values = (np.arange(runs.shape[0]) % 2).astype(np.uint8)
+    return np.repeat(values, runs.astype(np.int64)).reshape((height, width), order='F')
+
+# Appends images to the field files and makes them visible with commit(), which rewrites index.npz atomically.
+# The index records the committed size of every file and how many source images were processed (cached, skipped
+# or failed), so with resume=True a crashed run truncates the uncommitted tails and continues after the last commit.
+class DetectionCacheWriter(object):
+    def __init__(self, path=DETECTION_CACHE, resume=False):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        index_path = os.path.join(path, 'index.npz')
+        if resume and os.path.exists(index_path):
+            index = np.load(index_path)
+            self.pred_offsets, self.gt_offsets, self.run_offsets = [ index[key].tolist() for key in ('pred_offsets', 'gt_offsets', 'run_offsets') ]
+            self.image_shapes = [ tuple(shape) for shape in index['image_shapes'].tolist() ]
+            self.image_ids = index['image_ids'].tolist()
+            self.failed_ids = index['failed_ids'].tolist()
+            self.num_processed = int(index['num_processed'])
+            self.roi_mask_size, self.num_classes = int(index['roi_mask_size']), int(index['num_classes'])
+            self.files = {}
+            for field in FIELDS:
+                f = open(os.path.join(path, field + '.bin'), 'r+b')
+                f.truncate(int(index['bytes_' + field]))
+                f.seek(0, os.SEEK_END)
+                self.files[field] = f
+        else:
+            if os.path.exists(index_path):
+                os.remove(index_path)
+            self.pred_offsets, self.gt_offsets, self.run_offsets = [0,], [0,], [0,]
+            self.image_shapes, self.image_ids, self.failed_ids = [], [], []
+            self.num_processed = 0
+            self.roi_mask_size, self.num_classes = 0, 0
+            self.files = { field: open(os.path.join(path, field + '.bin'), 'wb') for field in FIELDS }
+
+    def _write(self, field, array):
+        self.files[field].write(np.ascontiguousarray(array, dtype=FIELDS[field]).tobytes())
+
+    # boxes: detectron2 Boxes, roi_masks: ROIMasks, softmax_output: P x C, gt_classes: G, gt_masks: G x H x W
+    def append(self, boxes, roi_masks, softmax_output, gt_classes, gt_masks, image_id=-1):
+        roi_mask_tensor = roi_masks.tensor.cpu().numpy()
+        if roi_mask_tensor.shape[0] > 0:
+            self.roi_mask_size = roi_mask_tensor.shape[1]
+            self.num_classes = softmax_output.shape[1]
+        self._write('boxes', boxes.tensor.cpu().numpy())
+        self._write('roi_masks', roi_mask_tensor)
+        self._write('softmax', softmax_output.cpu().numpy())
+        self._write('gt_classes', gt_classes.cpu().numpy())
+        for mask in gt_masks.cpu().numpy():
+            runs = encode_mask_runs(mask)
+            self._write('gt_mask_runs', runs)
+            self.run_offsets = self.run_offsets + [self.run_offsets[-1] + runs.shape[0],]
+        self.pred_offsets = self.pred_offsets + [self.pred_offsets[-1] + roi_mask_tensor.shape[0],]
+        self.gt_offsets = self.gt_offsets + [self.gt_offsets[-1] + gt_classes.shape[0],]
+        self.image_shapes = self.image_shapes + [(gt_masks.shape[1], gt_masks.shape[2]),]
+        self.image_ids = self.image_ids + [image_id,]
+
+    # num_processed counts the source images handled so far, including the ones that were not cached.
+    def commit(self, num_processed=None, failed_ids=[]):
+        self.num_processed = len(self.image_shapes) if num_processed is None else num_processed
+        self.failed_ids = self.failed_ids + list(failed_ids)
+        sizes = {}
+        for field, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            sizes['bytes_' + field] = f.tell()
+        np.savez(os.path.join(self.path, 'index.tmp.npz'),
+                 pred_offsets=np.array(self.pred_offsets), gt_offsets=np.array(self.gt_offsets), run_offsets=np.array(self.run_offsets),
+                 image_shapes=np.array(self.image_shapes, dtype=np.int64).reshape(-1,2), image_ids=np.array(self.image_ids, dtype=np.int64),
+                 failed_ids=np.array(self.failed_ids, dtype=np.int64), num_processed=self.num_processed,
+                 roi_mask_size=self.roi_mask_size, num_classes=self.num_classes, **sizes)
+        os.replace(os.path.join(self.path, 'index.tmp.npz'), os.path.join(self.path, 'index.npz'))
+        with open(os.path.join(self.path, 'progress.json'), 'w') as f:
+            json.dump({'num_processed': self.num_processed, 'num_cached': len(self.image_shapes), 'failed_ids': self.failed_ids}, f)
+
+    def close(self, num_processed=None, failed_ids=[]):
+        self.commit(num_processed, failed_ids)
+        for f in self.files.values():
+            f.close()
+
+class DetectionCache(object):
+    def __init__(self, path=DETECTION_CACHE):
+        index = np.load(os.path.join(path, 'index.npz'))
+        self.pred_offsets, self.gt_offsets, self.run_offsets, self.image_shapes = [ index[key] for key in ('pred_offsets', 'gt_offsets', 'run_offsets', 'image_shapes') ]
+        self.image_ids = index['image_ids']
+        self.roi_mask_size, self.num_classes = int(index['roi_mask_size']), int(index['num_classes'])
+        self.arrays = {}
+        for field, dtype in FIELDS.items():
+            filename = os.path.join(path, field + '.bin')
+            self.arrays[field] = np.memmap(filename, dtype=dtype, mode='r') if os.path.getsize(filename) > 0 else np.zeros((0,), dtype=dtype)
+
+    def __len__(self):
+        return self.image_shapes.shape[0]
+
+    def _predictions(self, field, i, shape):
+        start, stop = self.pred_offsets[i], self.pred_offsets[i+1]
+        size = int(np.prod(shape))
+        return torch.from_numpy(np.array(self.arrays[field][start*size:stop*size])).reshape((stop-start,) + shape)
+
+    def boxes(self, i):
+        from detectron2.structures import Boxes
+        return Boxes(self._predictions('boxes', i, (4,)))
+
+    def roi_masks(self, i):
+        from detectron2.structures import ROIMasks
+        return ROIMasks(self._predictions('roi_masks', i, (self.roi_mask_size, self.roi_mask_size)))
+
+    def softmax(self, i):
+        return self._predictions('softmax', i, (self.num_classes,))
+
+    def gt_classes(self, i):
+        return torch.from_numpy(np.array(self.arrays['gt_classes'][self.gt_offsets[i]:self.gt_offsets[i+1]]))
+
+    def gt_masks(self, i):
+        height, width = self.image_shapes[i]
+        masks = np.zeros((self.gt_offsets[i+1]-self.gt_offsets[i], height, width), dtype=np.uint8)
+        for g, gt in enumerate(range(self.gt_offsets[i], self.gt_offsets[i+1])):
+            masks[g] = decode_mask_runs(self.arrays['gt_mask_runs'][self.run_offsets[gt]:self.run_offsets[gt+1]], height, width)
+        return torch.from_numpy(masks)
+
+    # List-like views, so the columns can stand in for the lists the pickles held.
+    def columns(self):
+        return tuple( CacheColumn(getter, range(len(self))) for getter in (self.boxes, self.roi_masks, self.softmax, self.gt_classes, self.gt_masks) )
+
+# Decodes image i on access; slicing gives another lazy column.
+class CacheColumn(object):
+    def __init__(self, getter, images):
+        self.getter = getter
+        self.images = images
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return CacheColumn(self.getter, self.images[key])
+        return self.getter(self.images[key])
+
+# Returns boxes, roi_masks, softmax_outputs, gt_classes, gt_masks, from the columnar cache if there is one,
+# otherwise from the five pickles written by older versions of cache_data.
+def load_detection_cache(path=DETECTION_CACHE, pickle_dir='./.cache/'):
+    if os.path.exists(os.path.join(path, 'index.npz')):
+        return DetectionCache(path).columns()
+    return load_pickles(pickle_dir)
+
+# A hash of the cache that load_detection_cache would read: index.npz for the columnar cache, which records the
+# committed size of every field file, otherwise the pickles. Anything derived from the cache is keyed on it.
+def detection_cache_fingerprint(path=DETECTION_CACHE, pickle_dir='./.cache/'):
+    if os.path.exists(os.path.join(path, 'index.npz')):
+        files = [ os.path.join(path, 'index.npz') ]
+    else:
+        files = [ os.path.join(pickle_dir, name + '.pkl') for name in ('boxes', 'roi_masks', 'softmax', 'gt_classes', 'gt_masks') ]
+    digest = hashlib.sha256()
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def load_pickles(pickle_dir='./.cache/'):
+    columns = []
+    for name in ('boxes', 'roi_masks', 'softmax', 'gt_classes', 'gt_masks'):
+        with open(os.path.join(pickle_dir, name + '.pkl'), 'rb') as f:
+            columns = columns + [pkl.load(f),]
+    return tuple(columns)
+
+def convert_pickles(pickle_dir='./.cache/', path=DETECTION_CACHE):
+    boxes, roi_masks, softmax_outputs, gt_classes, gt_masks = load_pickles(pickle_dir)
+    writer = DetectionCacheWriter(path)
+    for i in tqdm(range(len(roi_masks))):
+        writer.append(boxes[i], roi_masks[i], softmax_outputs[i], gt_classes[i], gt_masks[i])
+    writer.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert the pickled detection cache to the columnar format')
+    parser.add_argument('--pickle_dir', type=str, default='./.cache/')
+    parser.add_argument('--path', type=str, default=DETECTION_CACHE)
+    args = parser.parse_args()
+    convert_pickles(args.pickle_dir, args.path)
@@ -4,7 +4,8 @@ sys.path.insert(1, os.path.join(os.path.abspath(os.path.dirname(__file__)), '../
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
-import os, gc, time, json, cv2, random, sys, traceback
+import os, gc, time, json, cv2, random, sys, traceback, functools
+from collections import deque
 from experiments.detection.utils import *
 from core.bounds import hb_p_value
 from core.concentration import *
@@ -65,10 +66,7 @@ def calculate_all_p_values(calib_tables, alphas):
     n = calib_tables.shape[0]
     # Get p-values for each loss
     r_hats = calib_tables.mean(axis=0).squeeze().flatten(start_dim=1) # empirical risk at each lambda combination
-    p_values = np.zeros_like(r_hats)
-    for r in range(p_values.shape[0]):
-        for i in range(p_values.shape[1]): 
-            p_values[r,i] = hb_p_value(r_hats[r,i],n,alphas[r])
+    p_values = hb_p_value(r_hats.numpy(),n,np.array(alphas)[:,None])
 
     return p_values
 
@@ -96,12 +94,7 @@ def split_fixed_sequence(calib_tables, alphas, delta):
     # Find a lambda for each value of beta that controls the risk best.
     num_betas = 200 
     betas = np.logspace(-9,0,num_betas)
-    lambda_sequence = np.zeros_like(betas)
-    for b in range(num_betas):
-        beta = betas[b]
-        differences = np.abs(p_values_coarse - beta)
-        infty_norms = np.linalg.norm(differences, ord=np.inf, axis=0)
-        lambda_sequence[b] = infty_norms.argmin()
+    lambda_sequence = split_fixed_sequence_path(p_values_coarse, betas)
 
     _, idx = np.unique(lambda_sequence, return_index=True)
     lambda_sequence_ordered = lambda_sequence[np.sort(idx)]
@@ -113,12 +106,16 @@ def split_fixed_sequence(calib_tables, alphas, delta):
 
     return rejections 
 
-def trial(i, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid, num_calib, loss_tables, risks, lhats):
+# Set before the pool forks and moved to shared memory, so every worker reads the same loss table without it
+# ever going through a pipe.
+_trial_tables = None
+
+def trial(i, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid, num_calib):
     fix_randomness(seed=(i*10000))
-    n = loss_tables["tensor"].shape[0]
+    n = _trial_tables.shape[0]
     perm = torch.randperm(n)
 
-    local_tables = loss_tables["tensor"][perm]
+    local_tables = _trial_tables[perm]
     calib_tables, val_tables = (local_tables[:num_calib], local_tables[num_calib:])
 
     if method == "Bonferroni":
@@ -128,10 +125,19 @@ def trial(i, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l
     elif method == "Split Fixed Sequence":
         R = split_fixed_sequence(calib_tables, alphas, delta)
 
+    lhat, idxs = select_lambda(R, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid)
+    if idxs is None:
+        return i, lhat, np.array([0.0,0.0,0.0])
+
+    # Validate
+    risk = val_tables[(slice(None),slice(None))+idxs].mean(dim=0).numpy()
+    return i, lhat, risk
+
+# Picks lhat out of the rejected lambdas R and returns it with its (idx1, idx2, idx3) in the grid, or
+# ([1,1,1], None) if nothing was rejected.
+def select_lambda(R, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid):
     if R.shape[0] == 0:
-        lhats[i] = np.array([1.0,1.0,1.0])
-        risks[i] = np.array([0.0,0.0,0.0])
-        loss_tables["curr_proc"] -= 1
+        return np.array([1.0,1.0,1.0]), None
 
     # Index the lambdas
     l1s = l1_meshgrid[R]
@@ -142,20 +148,64 @@ def trial(i, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l
     l2 = l2s[(l3s > l1s) & (l3s==l3)].median()
     l1 = l1s[(l3s > l1s) & (l2s==l2) & (l3s==l3)].min()
 
-    lhats[i] = np.array([l1,l2,l3])
+    lhat = np.array([l1,l2,l3])
 
-    # Validate
+    idx1 = torch.nonzero(np.abs(lambda1s-lhat[0]) < 1e-10)[0][0].item()
+    idx2 = torch.nonzero(np.abs(lambda2s-lhat[1]) < 1e-10)[0][0].item()
+    idx3 = torch.nonzero(np.abs(lambda3s-lhat[2]) < 1e-10)[0][0].item()
+    return lhat, (idx1, idx2, idx3)
 
-    idx1 = torch.nonzero(np.abs(lambda1s-lhats[i][0]) < 1e-10)[0][0].item()
-    idx2 = torch.nonzero(np.abs(lambda2s-lhats[i][1]) < 1e-10)[0][0].item()
-    idx3 = torch.nonzero(np.abs(lambda3s-lhats[i][2]) < 1e-10)[0][0].item()
+# Bonferroni and split fixed sequence only look at the calibration risks, so all trials come out of the batched
+# trial engine at once: one matrix product per chunk of trials instead of a shuffled copy of the table per trial.
+# The splits come from np.random.default_rng(seed), so every method sees the same splits for a given seed.
+def run_trials_batched(loss_tables, method, alphas, delta, lambda1s, lambda2s, lambda3s, num_calib, num_trials, seed=0):
+    rng = np.random.default_rng(seed)
+    l1_meshgrid, l2_meshgrid, l3_meshgrid = flatten_lambda_meshgrid(lambda1s,lambda2s,lambda3s)
+    num_losses = loss_tables.shape[1]
+    if method == "Bonferroni":
+        cal_risks, val_risks = batched_split_risks(loss_tables, num_calib, num_trials, rng=rng)
+        p_values = hb_p_value(cal_risks.reshape((num_trials,num_losses,-1)),num_calib,np.array(alphas)[None,:,None])
+        rejections = holm(p_values.max(axis=1), delta)
 
-    risks[i] = val_tables[:,:,idx1,idx2,idx3].mean(dim=0)
-    loss_tables["curr_proc"] -= 1
-    del calib_tables
-    del val_tables
-    del local_tables
-    gc.collect()
+    elif method == "Split Fixed Sequence":
+        n_coarse = num_calib//2
+        coarse_risks, fine_risks, val_risks = batched_split_risks(loss_tables, num_calib, num_trials, num_coarse=n_coarse, rng=rng)
+        rejections = split_fixed_sequence_HB_batched(coarse_risks.reshape((num_trials,num_losses,-1)), fine_risks.reshape((num_trials,num_losses,-1)),
+                                                     n_coarse, num_calib-n_coarse, alphas, delta)
+
+    lhats, risks = [], []
+    for i in range(num_trials):
+        lhat, idxs = select_lambda(np.nonzero(rejections[i])[0], lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid)
+        lhats = lhats + [lhat,]
+        risks = risks + [np.array([0.0,0.0,0.0]) if idxs is None else val_risks[(i,slice(None))+idxs],]
+    return lhats, risks
+
+# Runs the trials on a fixed pool of forked workers, with at most max_pending trials queued at a time. Returns the
+# lhats and risks in trial order.
+def run_trials(loss_tables, method, alphas, delta, lambda1s, lambda2s, lambda3s, num_calib, num_trials, num_processes, max_pending=None):
+    global _trial_tables
+    _trial_tables = loss_tables.share_memory_()
+    l1_meshgrid, l2_meshgrid, l3_meshgrid = flatten_lambda_meshgrid(lambda1s,lambda2s,lambda3s)
+    run_trial = functools.partial(trial, method=method, alphas=alphas, delta=delta, lambda1s=lambda1s, lambda2s=lambda2s, lambda3s=lambda3s,
+                                  l1_meshgrid=l1_meshgrid, l2_meshgrid=l2_meshgrid, l3_meshgrid=l3_meshgrid, num_calib=num_calib)
+    max_pending = 2*num_processes if max_pending is None else max_pending
+    lhats, risks = [None,]*num_trials, [None,]*num_trials
+    # One torch thread per worker so the workers, not intra-op threads, use the cores
+    with mp.get_context('fork').Pool(num_processes, initializer=torch.set_num_threads, initargs=(1,)) as pool:
+        pending = deque()
+        pbar = tqdm(total=num_trials)
+        def collect():
+            i, lhats[i], risks[i] = pending.popleft().get()
+            pbar.update(1)
+        for i in range(num_trials):
+            pending.append(pool.apply_async(run_trial, (i,)))
+            if len(pending) >= max_pending:
+                collect()
+        while len(pending) > 0:
+            collect()
+        pbar.close()
+    _trial_tables = None
+    return lhats, risks
 
 if __name__ == "__main__":
     sns.set(palette='pastel',font='serif')
@@ -163,17 +213,13 @@ if __name__ == "__main__":
     num_trials = 1000 
     num_calib = 3000 
     num_processes = 30 
-    mp.set_start_method('fork')
+    batched = True # False runs one shuffled trial per worker instead of the batched trial engine
     alphas = [0.25, 0.5, 0.5] # neg_m_coverage, neg_miou, neg_recall
     delta = 0.1
     lambda1s = torch.linspace(0.5,0.8,50) # Top score threshold
     lambda2s = torch.linspace(0.3,0.7,5) # Segmentation threshold
     lambda3s = torch.logspace(-0.00436,0,25) # APS threshold
 
-    # Multiprocessing setup
-    manager = mp.Manager()
-    loss_tables = manager.dict({"tensor": None, "curr_proc": 0})
-
     df_list = []
     methods = ["Bonferroni", "Split Fixed Sequence"]
     for method in methods:
@@ -184,35 +230,13 @@ if __name__ == "__main__":
             with torch.no_grad():
                 # Load cache
                 with open('./.cache/loss_tables.pt', 'rb') as f:
-                    #loss_tables["tensor"] = torch.tensor(np.random.random(size=(num_calib*2,3,lambda1s.shape[0],lambda2s.shape[0],lambda3s.shape[0])))/10
-                    loss_tables["tensor"] = torch.load(f)
-
-                risks = manager.dict({k:np.zeros((3,)) for k in range(num_trials)})
-                lhats = manager.dict({k:np.zeros((3,)) for k in range(num_trials)})
-                l1_meshgrid, l2_meshgrid, l3_meshgrid = flatten_lambda_meshgrid(lambda1s,lambda2s,lambda3s)
-
-                # Test trial
-                #trial(0, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid, num_calib, loss_tables, risks, lhats)
-                # Queue the jobs
-                jobs = []
-                for i in range(num_trials):
-                    p = mp.Process(target = trial, args = (i, method, alphas, delta, lambda1s, lambda2s, lambda3s, l1_meshgrid, l2_meshgrid, l3_meshgrid, num_calib, loss_tables, risks, lhats)) 
-                    jobs.append(p)
-
-                pbar = tqdm(total=num_trials)
-
-                # Run the jobs
-                for proc in jobs:
-                    while loss_tables["curr_proc"] >= num_processes:
-                        time.sleep(2)
-                    proc.start()
-                    loss_tables["curr_proc"] += 1
-                    pbar.update(1)
-
-                pbar.close()
-
-                for proc in jobs:
-                    proc.join()
+                    #loss_tables = torch.tensor(np.random.random(size=(num_calib*2,3,lambda1s.shape[0],lambda2s.shape[0],lambda3s.shape[0])))/10
+                    loss_tables = torch.load(f)
+
+                if batched:
+                    lhats, risks = run_trials_batched(loss_tables, method, alphas, delta, lambda1s, lambda2s, lambda3s, num_calib, num_trials)
+                else:
+                    lhats, risks = run_trials(loss_tables, method, alphas, delta, lambda1s, lambda2s, lambda3s, num_calib, num_trials, num_processes)
 
                 # Form the large dataframe
                 local_df_list = []
@@ -2,7 +2,7 @@
 import numpy as np
 import torch
 import matplotlib.pyplot as plt
-import os, json, cv2, random, sys, traceback
+import os, json, cv2, random, sys, traceback, argparse, functools
 
 import multiprocessing as mp
 
@@ -10,6 +10,10 @@ import pickle as pkl
 from tqdm import tqdm
 import pdb
 from profilehooks import profile
+try:
+    from .detection_cache import load_detection_cache, detection_cache_fingerprint
+except:
+    from detection_cache import load_detection_cache, detection_cache_fingerprint
 
 def fix_randomness(seed=0):
     np.random.seed(seed=seed)
@@ -17,47 +21,163 @@ def fix_randomness(seed=0):
     torch.cuda.manual_seed(seed)
     random.seed(seed)
 
-def get_loss_tables():
+# With mask_cache_path, each shard's worker pastes its masks into a memmapped file in that directory, reused across runs.
+# The images are split into shards of shard_size built by num_processes workers; finished shards are kept in
+# SHARD_DIR, so an interrupted run resumes where it stopped. With shard_indexes, only those shards are built
+# (e.g. one slice per machine sharing SHARD_DIR) and nothing is merged; a later full run merges them.
+def get_loss_tables(mask_cache_path=None, num_processes=1, shard_size=100, shard_indexes=None):
     print("Getting the loss tables!")
     with torch.no_grad():
-	# Load cache
-        with open('./.cache/boxes.pkl', 'rb') as f:
-            boxes = pkl.load(f)
+	# Load cache; the columnar cache is memory-mapped and decoded per image on access
+        boxes, roi_masks, softmax_outputs, gt_classes, gt_masks = load_detection_cache()
+        fingerprint = detection_cache_fingerprint()
 
-        with open('./.cache/roi_masks.pkl', 'rb') as f:
-            roi_masks = pkl.load(f)
-
-        with open('./.cache/softmax.pkl', 'rb') as f:
-            softmax_outputs = pkl.load(f)
-
-        with open('./.cache/gt_classes.pkl', 'rb') as f:
-            gt_classes = pkl.load(f)
-
-        with open('./.cache/gt_masks.pkl', 'rb') as f:
-            gt_masks = pkl.load(f)
-
-        n = len(roi_masks)        
         lambda1s = torch.linspace(0.5,0.8,50) # Top score threshold
         lambda2s = torch.linspace(0.3,0.7,5) # Segmentation threshold
         lambda3s = torch.logspace(-0.00436,0,25) # APS threshold
-        loss_tables = torch.zeros(n,3,lambda1s.shape[0],lambda2s.shape[0],lambda3s.shape[0])
 
         iou_correct = 0.5
 
-        for i in tqdm(range(lambda1s.shape[0])):
-            for j in range(lambda2s.shape[0]):
-                for k in range(lambda3s.shape[0]):
-                    confidence_threshold = lambda1s[i] 
-                    segmentation_threshold = lambda2s[j] 
-                    aps_threshold = lambda3s[k] 
-                    neg_m_coverages, neg_mious, neg_recalls = eval_detector(roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, confidence_threshold, segmentation_threshold, aps_threshold, iou_correct )
-                    loss_tables[:,0,i,j,k] = neg_m_coverages
-                    loss_tables[:,1,i,j,k] = neg_mious
-                    loss_tables[:,2,i,j,k] = neg_recalls
-                    print(f"l1: {lambda1s[i]:.3f}, l2: {lambda2s[j]:.3f}, l3: {lambda3s[k]:.3f}, Rhat1: {loss_tables[:,0,i,j,k].mean()}, Rhat2: {loss_tables[:,1,i,j,k].mean()}, Rhat3: {loss_tables[:,2,i,j,k].mean()}")
+        inputs = (roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s, lambda2s, lambda3s, iou_correct, mask_cache_path, fingerprint)
+        manifest = get_shard_manifest(len(roi_masks), shard_size, (lambda1s, lambda2s, lambda3s), fingerprint, SHARD_DIR)
+        build_shards(manifest, inputs, SHARD_DIR, num_processes, shard_indexes)
+        if shard_indexes is not None:
+            return None
+        loss_tables = merge_shards(manifest, SHARD_DIR)
+        for j in range(lambda2s.shape[0]):
+            print(f"l2: {lambda2s[j]:.3f}, min Rhat1: {loss_tables[:,0,:,j,:].mean(dim=0).min()}, min Rhat2: {loss_tables[:,1,:,j,:].mean(dim=0).min()}, min Rhat3: {loss_tables[:,2,:,j,:].mean(dim=0).min()}")
         torch.save(loss_tables, './.cache/loss_tables.pt')
         return loss_tables
 
+SHARD_DIR = './.cache/loss_table_shards/'
+
+# The manifest fixes the split of the images into shards, so every process and machine agrees on it. An existing
+# manifest is reused, and it must describe the same detection cache (by fingerprint), number of images and lambdas.
+def get_shard_manifest(n, shard_size, lambdas, fingerprint, shard_dir):
+    path = os.path.join(shard_dir, 'manifest.json')
+    lambdas = [ lambda_grid.tolist() for lambda_grid in lambdas ]
+    try:
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        os.makedirs(shard_dir, exist_ok=True)
+        shards = [ {'start': start, 'stop': min(start+shard_size,n), 'file': f'shard_{k:05d}.pt'} for k, start in enumerate(range(0,n,shard_size)) ]
+        manifest = {'n': n, 'lambdas': lambdas, 'fingerprint': fingerprint, 'shards': shards}
+        with open(path + f'.{os.getpid()}.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(path + f'.{os.getpid()}.tmp', path)
+    if manifest['n'] != n or manifest['lambdas'] != lambdas or manifest.get('fingerprint') != fingerprint:
+        raise ValueError(f"{path} was written for a different detection cache or lambdas; remove {shard_dir} to rebuild.")
+    return manifest
+
+# Set before the pool forks, so the workers share the loaded cache copy-on-write instead of unpickling it again.
+_shard_inputs = None
+
+def build_shard(shard_dir, shard):
+    roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s, lambda2s, lambda3s, iou_correct, mask_cache_path, fingerprint = _shard_inputs
+    rows = slice(shard['start'], shard['stop'])
+    with torch.no_grad():
+        pasted_masks = None
+        if mask_cache_path is not None:
+            pasted_masks = cache_pasted_masks(roi_masks[rows], boxes[rows], gt_masks[rows], lambda2s, os.path.join(mask_cache_path, os.path.splitext(shard['file'])[0]),
+                                              f"{fingerprint}:{shard['start']}:{shard['stop']}", progress=False)
+        loss_tables = build_loss_tables(roi_masks[rows], boxes[rows], softmax_outputs[rows], gt_classes[rows], gt_masks[rows], lambda1s, lambda2s, lambda3s, iou_correct,
+                                        pasted_masks=pasted_masks, progress=False)
+    path = os.path.join(shard_dir, shard['file'])
+    torch.save(loss_tables, path + f'.{os.getpid()}.tmp')
+    os.replace(path + f'.{os.getpid()}.tmp', path)
+    return shard['file']
+
+# CUDA cannot be used in a forked child, so the workers compute IoUs with a CPU backend (all backends give the same
+# IoUs), and one torch thread each so the workers, not intra-op threads, use the cores.
+def init_shard_worker():
+    global IOU_BACKEND
+    if IOU_BACKEND == 'repeat':
+        IOU_BACKEND = 'matmul'
+    torch.set_num_threads(1)
+
+def build_shards(manifest, inputs, shard_dir, num_processes=1, shard_indexes=None):
+    global _shard_inputs
+    _shard_inputs = inputs
+    shards = manifest['shards'] if shard_indexes is None else [ manifest['shards'][k] for k in shard_indexes ]
+    pending = [ shard for shard in shards if not os.path.exists(os.path.join(shard_dir, shard['file'])) ]
+    print(f"Building {len(pending)} of {len(shards)} shards")
+    if num_processes == 1:
+        for shard in tqdm(pending):
+            build_shard(shard_dir, shard)
+        return
+    with mp.get_context('fork').Pool(num_processes, initializer=init_shard_worker) as pool:
+        for _ in tqdm(pool.imap_unordered(functools.partial(build_shard, shard_dir), pending), total=len(pending)):
+            pass
+
+def merge_shards(manifest, shard_dir):
+    missing = [ shard['file'] for shard in manifest['shards'] if not os.path.exists(os.path.join(shard_dir, shard['file'])) ]
+    if len(missing) > 0:
+        raise FileNotFoundError(f"Cannot merge, {len(missing)} shards are missing: {missing}")
+    loss_tables = None
+    for shard in manifest['shards']:
+        rows = torch.load(os.path.join(shard_dir, shard['file']))
+        if loss_tables is None:
+            loss_tables = torch.zeros((manifest['n'],) + rows.shape[1:])
+        loss_tables[shard['start']:shard['stop']] = rows
+    return loss_tables
+
+# One pass per (image, segmentation threshold) fills the loss table for every lambda1 and lambda3 at once.
+# The masks of each image are pasted once for all lambda2s, or read from pasted_masks (see cache_pasted_masks).
+def build_loss_tables(roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s, lambda2s, lambda3s, iou_correct, pasted_masks=None, progress=True):
+    n = len(roi_masks)
+    loss_tables = torch.zeros(n,3,lambda1s.shape[0],lambda2s.shape[0],lambda3s.shape[0])
+    for i in tqdm(range(n), disable=not progress):
+        # Indexing a cache column loads the image, so fetch each input once rather than once per lambda2
+        roi_mask, box, softmax_output, image_gt_classes, image_gt_masks = roi_masks[i], boxes[i], softmax_outputs[i], gt_classes[i], gt_masks[i]
+        if pasted_masks is None:
+            height, width = image_gt_masks.shape[1], image_gt_masks.shape[2]
+            codes, regions = paste_mask_codes(roi_mask, box, height, width, lambda2s)
+            image_pasted_masks = PastedMasks(codes, regions, height, width, lambda2s)
+        else:
+            image_pasted_masks = pasted_masks[i]
+        for j in range(lambda2s.shape[0]):
+            loss_tables[i,:,:,j,:] = eval_image_sweep(roi_mask,box,softmax_output,image_gt_classes,image_gt_masks,lambda1s,lambda2s[j],lambda3s,iou_correct,pasted_masks=image_pasted_masks)
+    return loss_tables
+
+# The original triple loop, one eval_detector call per (lambda1, lambda2, lambda3).
+def build_loss_tables_reference(roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s, lambda2s, lambda3s, iou_correct):
+    loss_tables = torch.zeros(len(roi_masks),3,lambda1s.shape[0],lambda2s.shape[0],lambda3s.shape[0])
+    for i in tqdm(range(lambda1s.shape[0])):
+        for j in range(lambda2s.shape[0]):
+            for k in range(lambda3s.shape[0]):
+                neg_m_coverages, neg_mious, neg_recalls = eval_detector(roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s[i], lambda2s[j], lambda3s[k], iou_correct )
+                loss_tables[:,0,i,j,k] = neg_m_coverages
+                loss_tables[:,1,i,j,k] = neg_mious
+                loss_tables[:,2,i,j,k] = neg_recalls
+    return loss_tables
+
+# Compares build_loss_tables against the triple loop on a small synthetic dataset; the tables must be identical.
+def check_loss_tables(num_images=20, height=48, width=64, seed=0):
+    from detectron2.structures import Boxes, ROIMasks
+    fix_randomness(seed=seed)
+    roi_masks, boxes, softmax_outputs, gt_classes, gt_masks = [], [], [], [], []
+    for i in range(num_images):
+        num_preds = np.random.randint(0,12)
+        num_gts = np.random.randint(1,8)
+        corners = torch.rand(num_preds,2,2) * torch.tensor([width,height]).float()
+        roi_masks = roi_masks + [ROIMasks(torch.rand(num_preds,28,28)),]
+        boxes = boxes + [Boxes(torch.cat((corners.min(dim=1)[0], corners.max(dim=1)[0]+1),dim=1)),]
+        # Peaked softmaxes so the top scores spread over the lambda1 range
+        softmax_outputs = softmax_outputs + [(6*torch.randn(num_preds,80)).softmax(dim=1),]
+        gt_classes = gt_classes + [torch.randint(0,80,(num_gts,)),]
+        gt_masks = gt_masks + [(torch.rand(num_gts,height,width) > torch.rand(num_gts,1,1)).to(torch.uint8),]
+    lambda1s = torch.linspace(0.5,0.8,50)
+    lambda2s = torch.linspace(0.3,0.7,5)
+    lambda3s = torch.logspace(-0.00436,0,25)
+    args = (roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, lambda1s, lambda2s, lambda3s, 0.5)
+    reference = build_loss_tables_reference(*args)
+    swept = build_loss_tables(*args)
+    assert torch.equal(reference, swept), f"Loss tables differ by up to {(reference-swept).abs().max()}"
+    pasted_masks = cache_pasted_masks(roi_masks, boxes, gt_masks, lambda2s, './.cache/check_pasted_masks', f'check_{num_images}_{height}_{width}_{seed}')
+    swept = build_loss_tables(*args, pasted_masks=pasted_masks)
+    assert torch.equal(reference, swept), f"Loss tables from the memmapped masks differ by up to {(reference-swept).abs().max()}"
+    print("Loss tables match.")
 
 # Three risks: 1-mcoverage (APS), 1-mIOU@50, and 1-recall
 def eval_detector(roi_masks, boxes, softmax_outputs, gt_classes, gt_masks, confidence_threshold, segmentation_threshold, aps_threshold, iou_correct):
@@ -107,14 +227,7 @@ def eval_image(roi_mask, box, softmax_output, gt_classes, gt_masks, confidence_t
     #rank_of_true = (pi == labels_ind[:index_split,None]).int().argmax(dim=1) + 1
 
     # Starting with the most confident mask, correspond it with a ground truth mask based on IOU
-    pred_masks = pred_masks.cuda()
-    gt_masks = gt_masks.cuda()
-    repeated_pred_masks = pred_masks.repeat(gt_masks.shape[0],1,1,1).permute(1,0,2,3)
-    repeated_gt_masks = gt_masks.repeat(pred_masks.shape[0],1,1,1)
-    addition_pairwise = repeated_pred_masks + repeated_gt_masks
-    intersections_pairwise = ( addition_pairwise == 2 ).float().sum(dim=2).sum(dim=2)
-    unions_pairwise = ( addition_pairwise >= 1 ).float().sum(dim=2).sum(dim=2)
-    ious_pairwise = intersections_pairwise/torch.max(unions_pairwise,torch.tensor([1.0,]).cuda())
+    ious_pairwise = pairwise_mask_ious(pred_masks, gt_masks)
 
     ious = torch.zeros_like(top_scores)
     corrects = torch.zeros_like(top_scores)
@@ -135,8 +248,210 @@ def eval_image(roi_mask, box, softmax_output, gt_classes, gt_masks, confidence_t
 
     return corrects, ious, unused, covered
 
+# Pairwise mask IoUs, P x G. 'repeat' is the original GPU computation over repeated P x G x H x W masks,
+# 'matmul' takes the intersections from one product of the flattened masks, and 'rle' runs pycocotools on
+# run-length encodings; the last two run on CPU. Intersections and unions are integer pixel counts below 2^24,
+# exact in float32, so every backend gives the same IoUs. Set with --iou_backend or by assigning IOU_BACKEND.
+IOU_BACKENDS = ('repeat', 'matmul', 'rle')
+IOU_BACKEND = 'repeat' if torch.cuda.is_available() else 'matmul'
+
+def pairwise_mask_ious(pred_masks, gt_masks, backend=None):
+    backend = IOU_BACKEND if backend is None else backend
+    if backend == 'matmul':
+        return pairwise_mask_ious_matmul(pred_masks, gt_masks)
+    if backend == 'rle':
+        return pairwise_mask_ious_rle(pred_masks, gt_masks)
+    pred_masks = pred_masks.cuda()
+    gt_masks = gt_masks.cuda()
+    repeated_pred_masks = pred_masks.repeat(gt_masks.shape[0],1,1,1).permute(1,0,2,3)
+    repeated_gt_masks = gt_masks.repeat(pred_masks.shape[0],1,1,1)
+    addition_pairwise = repeated_pred_masks + repeated_gt_masks
+    intersections_pairwise = ( addition_pairwise == 2 ).float().sum(dim=2).sum(dim=2)
+    unions_pairwise = ( addition_pairwise >= 1 ).float().sum(dim=2).sum(dim=2)
+    ious_pairwise = intersections_pairwise/torch.max(unions_pairwise,torch.tensor([1.0,]).cuda())
+    return ious_pairwise
+
+def pairwise_mask_ious_matmul(pred_masks, gt_masks):
+    pred_flat = pred_masks.reshape(pred_masks.shape[0],gt_masks.shape[1]*gt_masks.shape[2]).float()
+    gt_flat = gt_masks.reshape(gt_masks.shape[0],gt_masks.shape[1]*gt_masks.shape[2]).float()
+    intersections_pairwise = pred_flat @ gt_flat.T
+    unions_pairwise = pred_flat.sum(dim=1)[:,None] + gt_flat.sum(dim=1)[None,:] - intersections_pairwise
+    return intersections_pairwise/torch.max(unions_pairwise,torch.tensor([1.0,]))
+
+# pycocotools divides in float64; rounding that quotient of integers to float32 gives the float32 quotient.
+def pairwise_mask_ious_rle(pred_masks, gt_masks):
+    import pycocotools.mask as maskUtils
+    if pred_masks.shape[0] == 0 or gt_masks.shape[0] == 0:
+        return torch.zeros((pred_masks.shape[0],gt_masks.shape[0]))
+    pred_rles = maskUtils.encode(np.asfortranarray(pred_masks.permute(1,2,0).cpu().numpy().astype(np.uint8)))
+    gt_rles = maskUtils.encode(np.asfortranarray(gt_masks.permute(1,2,0).cpu().numpy().astype(np.uint8)))
+    ious_pairwise = maskUtils.iou(pred_rles, gt_rles, [0,]*len(gt_rles))
+    return torch.tensor(ious_pairwise, dtype=torch.float32).reshape(pred_masks.shape[0],gt_masks.shape[0])
+
+# Pasted masks of one image. Each instance keeps only the box-cropped region that detectron2 pastes into, as uint8
+# codes counting the segmentation thresholds each pixel's probability reaches, so the bitmask at any threshold of the
+# grid is one comparison against the codes and matches roi_mask.to_bitmasks exactly. codes may be memmap slices.
+class PastedMasks(object):
+    def __init__(self, codes, regions, height, width, segmentation_thresholds):
+        self.codes = codes
+        self.regions = regions
+        self.height = height
+        self.width = width
+        self.thresholds = torch.as_tensor(segmentation_thresholds).sort()[0]
+
+    def bitmasks(self, segmentation_threshold):
+        levels = torch.nonzero(self.thresholds == segmentation_threshold)
+        if levels.shape[0] == 0:
+            raise ValueError(f"Segmentation threshold {segmentation_threshold} was not pasted; pasted thresholds are {self.thresholds.tolist()}")
+        level = levels[0,0].item()
+        if len(self.codes) == 0:
+            # paste_masks_in_image returns an empty uint8 tensor here
+            return torch.zeros((0,self.height,self.width), dtype=torch.uint8)
+        masks = torch.zeros((len(self.codes),self.height,self.width), dtype=torch.bool)
+        for p in range(len(self.codes)):
+            y0, y1, x0, x1 = [ int(coordinate) for coordinate in self.regions[p] ]
+            masks[p,y0:y1,x0:x1] = torch.from_numpy(np.asarray(self.codes[p])) > level
+        return masks
+
+# Pastes each instance's probabilities once on the CPU path of detectron2's paste_masks_in_image, one instance per
+# chunk with skip_empty, and counts the thresholds reached with the same >= comparison. Returns the codes and the
+# (y0, y1, x0, x1) region of each instance.
+def paste_mask_codes(roi_mask, box, height, width, segmentation_thresholds):
+    from detectron2.layers.mask_ops import _do_paste_mask
+    thresholds = torch.as_tensor(segmentation_thresholds).sort()[0]
+    boxes = box.tensor if not isinstance(box, torch.Tensor) else box
+    codes, regions = [], np.zeros((roi_mask.tensor.shape[0],4), dtype=np.int64)
+    for p in range(roi_mask.tensor.shape[0]):
+        probabilities, (rows, columns) = _do_paste_mask(roi_mask.tensor[p:p+1,None,:,:], boxes[p:p+1], height, width, skip_empty=True)
+        codes = codes + [(probabilities[0][:,:,None] >= thresholds[None,None,:]).sum(dim=2).to(torch.uint8).numpy(),]
+        regions[p] = (int(rows.start), int(rows.stop), int(columns.start), int(columns.stop))
+    return codes, regions
+
+# Pastes every image once into a single uint8 memmap at path, with an index of offsets and regions in path + '.npz',
+# and returns one PastedMasks per image viewing it. An existing cache is reused if it was written for the same
+# thresholds and the same fingerprint, which identifies the images (e.g. the detection cache fingerprint and rows).
+def cache_pasted_masks(roi_masks, boxes, gt_masks, segmentation_thresholds, path, fingerprint, progress=True):
+    thresholds = torch.as_tensor(segmentation_thresholds).sort()[0].numpy()
+    try:
+        index = np.load(path + '.npz')
+        assert np.array_equal(index['thresholds'], thresholds) and str(index['fingerprint']) == fingerprint and index['shapes'].shape[0] == len(roi_masks)
+    except (FileNotFoundError, KeyError, AssertionError):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        num_instances, shapes, regions, offsets = [], [], [], [0,]
+        tmp = path + f'.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            for i in tqdm(range(len(roi_masks)), disable=not progress):
+                image_gt_masks = gt_masks[i]
+                height, width = image_gt_masks.shape[1], image_gt_masks.shape[2]
+                codes, image_regions = paste_mask_codes(roi_masks[i], boxes[i], height, width, thresholds)
+                for code in codes:
+                    f.write(np.ascontiguousarray(code).tobytes())
+                    offsets = offsets + [offsets[-1] + code.size,]
+                num_instances = num_instances + [len(codes),]
+                shapes = shapes + [(height, width),]
+                regions = regions + [image_regions,]
+        os.replace(tmp, path)
+        np.savez(tmp + '.npz', thresholds=thresholds, fingerprint=np.array(fingerprint), num_instances=np.array(num_instances), shapes=np.array(shapes).reshape(-1,2),
+                 regions=np.concatenate(regions,axis=0) if len(regions) > 0 else np.zeros((0,4),dtype=np.int64), offsets=np.array(offsets))
+        os.replace(tmp + '.npz', path + '.npz')
+        index = np.load(path + '.npz')
+    num_instances, shapes, regions, offsets = [ index[key] for key in ('num_instances', 'shapes', 'regions', 'offsets') ]
+    flat_codes = np.memmap(path, dtype=np.uint8, mode='r') if offsets[-1] > 0 else np.zeros((0,), dtype=np.uint8)
+    pasted_masks = []
+    first_instance = 0
+    for i in range(shapes.shape[0]):
+        instances = range(first_instance, first_instance + num_instances[i])
+        codes = [ flat_codes[offsets[p]:offsets[p+1]].reshape(regions[p,1]-regions[p,0],regions[p,3]-regions[p,2]) for p in instances ]
+        pasted_masks = pasted_masks + [PastedMasks(codes, regions[first_instance:first_instance+num_instances[i]], shapes[i,0], shapes[i,1], thresholds),]
+        first_instance = first_instance + num_instances[i]
+    return pasted_masks
+
+# The greedy matching of eval_image, returning for each step the matched row, its IoU and the gt class it took.
+def greedy_match(ious_pairwise, gt_classes, indices):
+    rows, step_ious, step_gt_classes = [], [], []
+    unused = torch.tensor(range(gt_classes.shape[0]))
+    for index in indices:
+        if unused.shape[0] == 0:
+            break
+        _iou = ious_pairwise[index][unused]
+        max_iou, max_iou_idx = (_iou.max().item(), _iou.argmax().item())
+        rows = rows + [index.item(),]
+        step_ious = step_ious + [max_iou,]
+        step_gt_classes = step_gt_classes + [gt_classes[unused][max_iou_idx].item(),]
+        unused = unused[unused != unused[max_iou_idx]]
+    return rows, step_ious, step_gt_classes
+
+# Losses of eval_detector for one image, one segmentation threshold and all (lambda1, lambda3), as a 3 x L1 x L3 tensor.
+# eval_image keeps the first K stored detections, where K counts the top scores above lambda1, and matches them in
+# descending score order. Pasting and IoUs do not depend on K, and whenever the order for K is a prefix of the order
+# for the largest K, its matching is the first min(K, G) steps of one greedy pass; the APS threshold only changes
+# the set sizes. The per-K tensors are rebuilt with eval_image's layout so every reduction is bit-identical.
+def eval_image_sweep(roi_mask, box, softmax_output, gt_classes, gt_masks, confidence_thresholds, segmentation_threshold, aps_thresholds, iou_correct, pasted_masks=None):
+    losses = torch.zeros(3,confidence_thresholds.shape[0],aps_thresholds.shape[0])
+    if softmax_output.shape[0] == 0:
+        return losses
+    if pasted_masks is None:
+        pred_masks = roi_mask.to_bitmasks(box,gt_masks.shape[1],gt_masks.shape[2],segmentation_threshold).tensor
+    else:
+        pred_masks = pasted_masks.bitmasks(segmentation_threshold)
+    ious_pairwise = pairwise_mask_ious(pred_masks, gt_masks)
+
+    all_top_scores = softmax_output.max(dim=1)[0]
+    sorted_top_scores = all_top_scores.sort(descending=True)[0]
+    num_kept = (sorted_top_scores[None,:] > confidence_thresholds[:,None]).sum(dim=1)
+
+    est_classes = softmax_output.argmax(dim=1)
+
+    # Setup for APS, one column per threshold
+    test_sorted, test_pi = softmax_output.sort(dim=1, descending=True)
+    _, class_ranks = test_pi.sort(dim=1, descending=False)
+    sizes = (test_sorted.cumsum(dim=1)[:,:,None] <= aps_thresholds[None,None,:]).int().sum(dim=1)
+    sizes = torch.max(sizes,torch.ones_like(sizes))
+    sizes = torch.where(aps_thresholds[None,:] == 1.0, torch.max(sizes,80*torch.ones_like(sizes)), sizes)
+
+    K_max = num_kept.max().item()
+    full_indices = all_top_scores[:K_max].sort(descending=True)[1]
+    full_match = greedy_match(ious_pairwise, gt_classes, full_indices)
+    for K in torch.unique(num_kept).tolist():
+        if K == 0:
+            continue
+        num_steps = min(K, gt_classes.shape[0])
+        indices = all_top_scores[:K].sort(descending=True)[1]
+        if torch.equal(indices[:num_steps], full_indices[:num_steps]):
+            rows, step_ious, step_gt_classes = [ result[:num_steps] for result in full_match ]
+        else:
+            rows, step_ious, step_gt_classes = greedy_match(ious_pairwise, gt_classes, indices)
+        rows = torch.tensor(rows, dtype=torch.long)
+        step_gt_classes = torch.tensor(step_gt_classes, dtype=torch.long)
+
+        ious = torch.zeros((K,))
+        ious[rows] = torch.tensor(step_ious)
+        corrects = torch.zeros((K,))
+        corrects[rows] = (step_gt_classes == est_classes[rows]).float()
+        covered = torch.zeros((K,aps_thresholds.shape[0]))
+        covered[rows] = (class_ranks[rows,step_gt_classes][:,None] <= (sizes[rows] - 1)).float()
+
+        lambda1_idxs = num_kept == K
+        losses[0,lambda1_idxs] = 1 - covered.mean(dim=0)
+        losses[1,lambda1_idxs] = 1 - ious.mean()
+        losses[2,lambda1_idxs] = 1 - corrects.sum()/gt_classes.shape[0]
+    return losses
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build the detection loss tables')
+    parser.add_argument('--check', action='store_true', help='first compare the one-pass builder against the triple loop')
+    parser.add_argument('--iou_backend', type=str, default=IOU_BACKEND, choices=IOU_BACKENDS)
+    parser.add_argument('--mask_cache_path', type=str, default=None, help='directory where each shard memmaps its pasted masks instead of pasting each image in memory')
+    parser.add_argument('--num_processes', type=int, default=None, help='defaults to 1 with the repeat (CUDA) backend, otherwise one per core')
+    parser.add_argument('--shard_size', type=int, default=100, help='images per shard')
+    parser.add_argument('--shards', type=str, default=None, help='comma separated shard indexes to build without merging, e.g. one slice per machine')
+    args = parser.parse_args()
+    IOU_BACKEND = args.iou_backend
     fix_randomness(seed=0)
-    loss_tables = get_loss_tables()
+    if args.check:
+        check_loss_tables()
+    shard_indexes = [ int(k) for k in args.shards.split(',') ] if args.shards is not None else None
+    num_processes = args.num_processes if args.num_processes is not None else (1 if IOU_BACKEND == 'repeat' else mp.cpu_count())
+    loss_tables = get_loss_tables(args.mask_cache_path, num_processes, args.shard_size, shard_indexes)
     print(loss_tables)
     print("Success!")
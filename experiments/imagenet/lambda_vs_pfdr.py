@@ -29,9 +29,10 @@ def get_lambdas_vs_pfdps_frac_predict(lambdas,imagenet_val_dir):
     corrects = top_classes==labels
 
     with torch.no_grad():
-        idxs = [ top_scores > lam for lam in lambdas ]
-        frac_predict = np.array([ idx.float().mean() for idx in idxs ])
-        pfdps = np.array([ 1-corrects[idx].float().mean() for idx in idxs ]) 
+        num_predict, num_correct = sums_above_thresholds(top_scores.numpy(), corrects.float().numpy(), lambdas)
+        frac_predict = num_predict/top_scores.shape[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pfdps = 1-num_correct/num_predict
         pfdps = np.nan_to_num(pfdps)
         return pfdps, frac_predict
 
@@ -55,6 +55,21 @@ def plot_histograms(df_list,alpha,delta,pfdps,frac_predict,lambdas):
     plt.tight_layout()
     plt.savefig((f'outputs/histograms/pfdp_{alpha}_{delta}_imagenet_histograms').replace('.','_') + '.pdf')
 
+# gridless: the lambdas are the breakpoints of a held-out slice (fixed across trials and methods) inside the
+# coarse cells where its pFDP crosses alpha, so the grid and N are set before any calibration data is seen.
+# Returns the lambdas and the remaining examples, which the trials split into calibration and validation.
+def holdout_breakpoints(top_scores, corrects, alpha, num_holdout, num_coarse=100, max_points=1000):
+    perm = torch.randperm(top_scores.shape[0], generator=torch.Generator().manual_seed(0))
+    holdout_scores = top_scores[perm[:num_holdout]].numpy()
+    holdout_incorrects = 1-corrects[perm[:num_holdout]].float().numpy()
+    coarse_lambdas = np.linspace(0,1,num_coarse)
+    counts, incorrect_sums = sums_above_thresholds(holdout_scores, holdout_incorrects, coarse_lambdas)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pfdps = np.nan_to_num(incorrect_sums/counts)
+    lower, upper = crossing_region(coarse_lambdas, pfdps, alpha)
+    lambdas = threshold_breakpoints(holdout_scores, lower, upper, max_points)
+    return lambdas, top_scores[perm[num_holdout:]], corrects[perm[num_holdout:]]
+
 def trial_precomputed(rejection_region_function, top_scores, corrects, alpha, delta, lambdas, num_calib, maxiter):
     total=top_scores.shape[0]
     m=1000
@@ -85,7 +100,7 @@ def trial_precomputed(rejection_region_function, top_scores, corrects, alpha, de
     
     return pfdp, mean_size, lhat
 
-def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir):
+def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir,num_holdout=5000):
     df_list = []
     def monotonic_pfdr_bonferroni_search_HB(score_vector, correct_vector, lambdas, alpha, delta):
         return pfdr_bonferroni_search_HB(score_vector, correct_vector, lambdas, alpha, delta,downsample_factor=lambdas.shape[0])
@@ -97,7 +112,8 @@ def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir
     for idx in range(len(rejection_region_functions)):
         rejection_region_function = rejection_region_functions[idx]
         rejection_region_name = rejection_region_names[idx]
-        fname = f'./.cache/{alpha}_{delta}_{num_calib}_{num_trials}_{rejection_region_name}_dataframe.pkl'
+        gridless_tag = f'_gridless_{num_holdout}' if lambdas is None else ''
+        fname = f'./.cache/{alpha}_{delta}_{num_calib}_{num_trials}_{rejection_region_name}{gridless_tag}_dataframe.pkl'
 
         df = pd.DataFrame(columns = ["$\\hat{\\lambda}$","pFDP","mean size","alpha","delta","region name"])
         try:
@@ -112,6 +128,9 @@ def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir
             logits, labels = dataset_precomputed.tensors
             top_scores, top_classes = (logits/T.cpu()).softmax(dim=1).max(dim=1)
             corrects = top_classes==labels
+            trial_lambdas = lambdas
+            if lambdas is None:
+                trial_lambdas, top_scores, corrects = holdout_breakpoints(top_scores, corrects, alpha, num_holdout)
 
             #if rejection_region_name == "HBBonferroniSearch_J=1":
             #    pdb.set_trace()
@@ -119,7 +138,7 @@ def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir
             with torch.no_grad():
                 local_df_list = []
                 for i in tqdm(range(num_trials)):
-                    pfdp, mean_size, lhat = trial_precomputed(rejection_region_function, top_scores, corrects, alpha, delta, lambdas, num_calib, maxiter)
+                    pfdp, mean_size, lhat = trial_precomputed(rejection_region_function, top_scores, corrects, alpha, delta, trial_lambdas, num_calib, maxiter)
                     dict_local = {"$\\hat{\\lambda}$": lhat,
                                     "pFDP": pfdp,
                                     "mean size": mean_size,
@@ -134,8 +153,9 @@ def experiment(alpha,delta,lambdas,num_calib,num_trials,maxiter,imagenet_val_dir
                 df.to_pickle(fname)
 
         df_list = df_list + [df]
-    pfdps, frac_predict = get_lambdas_vs_pfdps_frac_predict(lambdas,imagenet_val_dir)
-    plot_histograms(df_list, alpha, delta, pfdps, frac_predict, lambdas)
+    plot_lambdas = np.linspace(0,1,1000) if lambdas is None else lambdas
+    pfdps, frac_predict = get_lambdas_vs_pfdps_frac_predict(plot_lambdas,imagenet_val_dir)
+    plot_histograms(df_list, alpha, delta, pfdps, frac_predict, plot_lambdas)
 
 def platt_logits(calib_dataset, max_iters=10, lr=0.01, epsilon=0.01):
     calib_loader = torch.utils.data.DataLoader(calib_dataset, batch_size=1024, shuffle=False, pin_memory=True) 
@@ -171,7 +191,7 @@ if __name__ == "__main__":
     maxiter = int(1e3)
     num_trials = 100 
     num_calib = 30000
-    lambdas = np.linspace(0,1,1000)
+    lambdas = np.linspace(0,1,1000) # None calibrates at held-out score breakpoints near alpha instead
     
     for alpha, delta in params:
         print(f"\n\n\n ============           NEW EXPERIMENT alpha={alpha} delta={delta}           ============ \n\n\n") 
@@ -149,23 +149,44 @@ def get_model_outputs():
         np.save('./.cache/error_scores_val.npy', error_scores_val)
     return X_val, y_val, mean_val, upper_val, lower_val, error_scores_val 
 
-def get_loss_table(alpha, num_lambdas):
+# n x N losses: the squared error where the model predicts (error score at most lambda), alpha where it abstains.
+def mse_losses(squared_errors, error_scores, lambdas, alpha):
+    bool_predict = error_scores[:,None] <= lambdas[None,:]
+    return (squared_errors[:,None] * bool_predict) - alpha*bool_predict + alpha
+
+# gridless: the lambdas are the breakpoints of a held-out slice of the validation outputs (fixed by seed and left
+# out of the loss table) inside the coarse quantile cells where its scaled MSE crosses alpha, so the grid and N
+# are set before any calibration data is seen. Returns the lambdas and the indexes of the remaining examples.
+def holdout_breakpoints(squared_errors, error_scores, alpha, num_holdout, num_coarse=100, max_points=1000):
+    perm = np.random.RandomState(0).permutation(error_scores.shape[0])
+    holdout = perm[:num_holdout]
+    coarse_lambdas = np.quantile(error_scores[holdout], np.linspace(0,1,num_coarse))
+    coarse_losses = mse_losses(squared_errors[holdout], error_scores[holdout], coarse_lambdas, alpha)
+    coarse_risks = coarse_losses.mean(axis=0)/coarse_losses.max()
+    lower, upper = crossing_region(coarse_lambdas, coarse_risks, alpha)
+    return threshold_breakpoints(error_scores[holdout], lower, upper, max_points), perm[num_holdout:]
+
+# num_lambdas=None tests at held-out error score breakpoints near alpha (see holdout_breakpoints) instead of
+# num_lambdas quantiles.
+def get_loss_table(alpha, num_lambdas, num_holdout=1000):
+    tag = f'{alpha}' if num_lambdas is not None else f'{alpha}_gridless_{num_holdout}'
     try:
         # encode loss (MSE) as 0th channel and abstentions as 1st channel.
-        loss_table = np.load(f'./.cache/{alpha}_loss_table.npy')
-        lambdas = np.load(f'./.cache/lambdas.npy')
+        loss_table = np.load(f'./.cache/{tag}_loss_table.npy')
+        lambdas = np.load(f'./.cache/{tag}_lambdas.npy')
     except:
         X_val, y_val, mean_val, upper_val, lower_val, error_scores_val = get_model_outputs()
-        lambdas = np.array( [ np.quantile(error_scores_val, q) for q in np.linspace(0,1,num_lambdas) ] )
+        if num_lambdas is None:
+            lambdas, rest = holdout_breakpoints((mean_val - y_val)**2, error_scores_val, alpha, num_holdout)
+            y_val, mean_val, error_scores_val = y_val[rest], mean_val[rest], error_scores_val[rest]
+        else:
+            lambdas = np.array( [ np.quantile(error_scores_val, q) for q in np.linspace(0,1,num_lambdas) ] )
         loss_table = np.zeros( (y_val.shape[0], 2, lambdas.shape[0]) )
-        squared_errors = (mean_val - y_val)**2
-        for i in range(lambdas.shape[0]):
-            bool_predict = error_scores_val <= lambdas[i]
-            # encode loss (MSE) as 0th channel and abstentions as 1st channel.
-            loss_table[:,0,i] = (squared_errors * bool_predict) - alpha*bool_predict + alpha
-            loss_table[:,1,i] = (~bool_predict).astype(float)
-        np.save(f'./.cache/{alpha}_loss_table.npy', loss_table)
-        np.save(f'./.cache/{alpha}_lambdas.npy', lambdas)
+        # encode loss (MSE) as 0th channel and abstentions as 1st channel.
+        loss_table[:,0,:] = mse_losses((mean_val - y_val)**2, error_scores_val, lambdas, alpha)
+        loss_table[:,1,:] = error_scores_val[:,None] > lambdas[None,:]
+        np.save(f'./.cache/{tag}_loss_table.npy', loss_table)
+        np.save(f'./.cache/{tag}_lambdas.npy', lambdas)
     return loss_table, lambdas
 
 def ltt_calibrate_evaluate(rejection_region_fn, rejection_region_name, loss_table, alpha, delta):
@@ -218,14 +239,34 @@ def plots(df, risk_curve, abstentions_curve, lambdas, alpha, delta):
     plt.tight_layout()
     plt.savefig(results_folder + (f'meps_{alpha}_{delta}_results').replace('.','_') + '.pdf')
 
-def run_experiment(rejection_region_functions,rejection_region_names,alpha,delta,num_trials,num_lambdas):
+# Splits the table into calibration and validation halves for every trial at once and evaluates a method whose
+# rejections only depend on the calibration risks, given as its batched counterpart. Returns the validation risk and
+# abstention fraction of each trial. The splits come from np.random.default_rng(seed), the same for every method.
+def ltt_calibrate_evaluate_batched(batched_rejection_region_fn, loss_table, alpha, delta, num_trials, seed=0):
+    mse_table, abstention_table = loss_table[:,0,:], loss_table[:,1,:]
+    mse_table = mse_table/mse_table.max() # scale all to 0-1
+    n = mse_table.shape[0]//2
+    cal_risks, val_risks = batched_split_risks(np.stack((mse_table, abstention_table), axis=1), n, num_trials, rng=np.random.default_rng(seed))
+    valid = batched_rejection_region_fn(cal_risks[:,0,:],n,alpha,delta)
+    ihats = np.where(valid, cal_risks[:,0,:], -np.Inf).argmax(axis=1) # the maximum risk valid index, 0 if none
+    trials = np.arange(num_trials)
+    return val_risks[trials,0,ihats], val_risks[trials,1,ihats]
+
+# Methods with a batched counterpart (not None) run all trials at once; the rest run one trial at a time.
+def run_experiment(rejection_region_functions,batched_rejection_region_functions,rejection_region_names,alpha,delta,num_trials,num_lambdas):
     loss_table, lambdas = get_loss_table(alpha, num_lambdas)
     risk_curve = loss_table[:,0,:].mean(axis=0)/loss_table[:,0,:].max()
     abstentions_curve = loss_table[:,1,:].mean(axis=0)
     risks, abstentions, region_names = [], [], []
     print(f"{num_trials} trials running!")
-    for i in tqdm(range(num_trials)):
-        for j in range(len(rejection_region_functions)):
+    for j in range(len(rejection_region_functions)):
+        if batched_rejection_region_functions[j] is not None:
+            batch_risks, batch_abstentions = ltt_calibrate_evaluate_batched(batched_rejection_region_functions[j], loss_table, alpha, delta, num_trials)
+            risks += list(batch_risks)
+            abstentions += list(batch_abstentions)
+            region_names += [rejection_region_names[j]]*num_trials
+            continue
+        for i in tqdm(range(num_trials)):
             risk, abstention = ltt_calibrate_evaluate(rejection_region_functions[j], rejection_region_names[j], loss_table, alpha, delta)
             risks += [risk]
             abstentions += [abstention]
@@ -241,16 +282,22 @@ if __name__ == "__main__":
     alpha = 0.1 
     delta = 0.1
     num_trials = 100
-    num_lambdas = 1000
+    num_lambdas = 1000 # None tests at held-out error score breakpoints near alpha instead of a quantile grid
     # local function to preserve template
     def _bonferroni_search_HB_J1(loss_table,lambdas,alpha,delta):
-        return bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor=num_lambdas)
+        return bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor=loss_table.shape[1])
 
     # local function to preserve template
     def _bonferroni_search_HB(loss_table,lambdas,alpha,delta):
         return bonferroni_search_HB(loss_table,lambdas,alpha,delta,downsample_factor=10)
+    def _bonferroni_search_HB_J1_batched(cal_risks,n,alpha,delta):
+        return bonferroni_search_HB_batched(cal_risks,n,alpha,delta,downsample_factor=cal_risks.shape[1])
+
+    def _bonferroni_search_HB_batched(cal_risks,n,alpha,delta):
+        return bonferroni_search_HB_batched(cal_risks,n,alpha,delta,downsample_factor=10)
     #rejection_region_functions = (bonferroni_HB,)
     #rejection_region_names = ('Bonferroni',)
     rejection_region_functions = ( uniform_region, bonferroni_HB, _bonferroni_search_HB, _bonferroni_search_HB_J1 )
+    batched_rejection_region_functions = ( None, bonferroni_HB_batched, _bonferroni_search_HB_batched, _bonferroni_search_HB_J1_batched )
     rejection_region_names = ( 'Uniform', 'Bonferroni', 'Fixed Sequence\n(Multi-Start)', 'Fixed Sequence' )
-    run_experiment(rejection_region_functions, rejection_region_names, alpha, delta, num_trials, num_lambdas)
+    run_experiment(rejection_region_functions, batched_rejection_region_functions, rejection_region_names, alpha, delta, num_trials, num_lambdas)
@@ -16,9 +16,8 @@ import pickle as pkl
 from tqdm import tqdm
 import seaborn as sns
 from utils import *
-from core.bounds import hb_p_value
+from core.bounds import hb_p_value, hb_p_value_binary
 from core.concentration import *
-from statsmodels.stats.multitest import multipletests
 import pdb
 import multiprocessing as mp
 import time
@@ -130,9 +129,9 @@ def calculate_corrected_p_values(calib_tables, alphas, lambda1s, lambda2s):
     n = calib_tables.shape[0]
     # Get p-values for each loss
     r_hats_risk1 = calib_tables[:,0,:].mean(axis=0).squeeze().flatten() # empirical risk at each lambda combination
-    p_values_risk1 = np.array([hb_p_value(r_hat,n,alphas[0]) for r_hat in r_hats_risk1])
+    p_values_risk1 = hb_p_value_binary(r_hats_risk1,n,alphas[0]) # OOD type I losses are binary
     r_hats_risk2 = (calib_tables[:,1,:] * (1-calib_tables[:,0,:]) - alphas[1]*(1-calib_tables[:,0,:])).mean(axis=0).squeeze().flatten() + alphas[1] # empirical risk at each lambda combination using trick
-    p_values_risk2 = np.array([hb_p_value(r_hat,n,alphas[1]) for r_hat in r_hats_risk2])
+    p_values_risk2 = hb_p_value(r_hats_risk2,n,alphas[1])
 
     # Combine them
     p_values_corrected = np.maximum(p_values_risk1,p_values_risk2) 
@@ -220,12 +219,10 @@ def coordsplit_test(loss_tables, alphas, delta, lambda1s, lambda2s, num_calib):
     r_hats_risk1 = loss_tables[:,0,:].mean(dim=0)
     r_hats_risk2 = (loss_tables[:,1,:] * (1-loss_tables[:,0,:]) - alphas[1]*(1-loss_tables[:,0,:])).mean(dim=0) + alphas[1] # empirical risk at each lambda combination using trick
     r_hats = torch.cat((r_hats_risk1[None,:],r_hats_risk2[None,:]),dim=0)
-    p_vals = torch.ones_like(r_hats)
     # Calculate the p-values
-    for (r, i, j), r_hat in np.ndenumerate(r_hats):
-        if r_hat > alphas[r]:
-            continue # assign a p-value of 1 
-        p_vals[r,i,j] = hb_p_value(r_hat,num_calib,alphas[r])
+    alphas_r = np.array(alphas)[:,None,None]
+    p_vals = np.where(r_hats.numpy() > alphas_r, 1.0, hb_p_value(r_hats.numpy(),num_calib,alphas_r)) # assign a p-value of 1 above alpha
+    p_vals = torch.tensor(p_vals, dtype=r_hats.dtype)
 
     lambda1_idx = np.argmax(p_vals[0,:,0] < delta/2).item()
     lambda2_idx = np.argmax(p_vals[1,lambda1_idx,:] < delta/2).item()
@@ -236,12 +233,10 @@ def graph_test(A, error_budget, loss_tables, alphas, delta, lambda1s, lambda2s,
     r_hats_risk1 = loss_tables[:,0,:].mean(dim=0)
     r_hats_risk2 = (loss_tables[:,1,:] * (1-loss_tables[:,0,:]) - alphas[1]*(1-loss_tables[:,0,:])).mean(dim=0) + alphas[1] # empirical risk at each lambda combination using trick
     r_hats = torch.cat((r_hats_risk1[None,:],r_hats_risk2[None,:]),dim=0)
-    p_vals = torch.ones_like(r_hats)
     # Calculate the p-values
-    for (r, i, j), r_hat in np.ndenumerate(r_hats):
-        if r_hat > alphas[r]:
-            continue # assign a p-value of 1 
-        p_vals[r,i,j] = hb_p_value(r_hat,num_calib,alphas[r])
+    alphas_r = np.array(alphas)[:,None,None]
+    p_vals = np.where(r_hats.numpy() > alphas_r, 1.0, hb_p_value(r_hats.numpy(),num_calib,alphas_r)) # assign a p-value of 1 above alpha
+    p_vals = torch.tensor(p_vals, dtype=r_hats.dtype)
     p_vals = p_vals.max(dim=0)[0]
     
     rejected_bool = torch.zeros_like(p_vals) > 1 # all false